@@ -0,0 +1,413 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import logging
+import shutil
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import generate_tests
+from mock_openai_server import MockCompletionsServer
+
+RESULTS_FILE = Path(__file__).resolve().parent / '.benchmarks' / 'results.jsonl'
+
+
+def make_synthetic_repo(root: Path, files: int = 50, import_depth: int = 3, tests: int = 20,
+                        functions: int = 8, language: str = 'python', seed: int = 0,
+                        size_skew: float = 0.0) -> List[str]:
+    """Write a synthetic project and return the source files it contains.
+
+    Modules are spread over packages of import_depth levels; each module
+    imports up to import_depth modules generated before it, and tests
+    import a random module. With size_skew > 0 the number of functions per
+    module is log-normally distributed around functions.
+    """
+    rng = random.Random(seed)
+    root.mkdir(parents=True, exist_ok=True)
+    languages = ['python', 'javascript'] if language == 'both' else [language]
+    sources = []
+
+    for index in range(files):
+        lang = languages[index % len(languages)]
+        package = Path(*[f"pkg{(index + level) % 3}" for level in range(import_depth)])
+        name = f"module_{index}"
+        earlier = [s for s in sources if s.endswith('.py') == (lang == 'python')]
+        imports = rng.sample(earlier, min(len(earlier), import_depth))
+        count = max(1, round(functions * rng.lognormvariate(0, size_skew))) if size_skew else functions
+
+        if lang == 'python':
+            path = package / f"{name}.py"
+            for level in range(1, import_depth + 1):
+                init_file = root / Path(*package.parts[:level]) / '__init__.py'
+                init_file.parent.mkdir(parents=True, exist_ok=True)
+                init_file.touch()
+            lines = [f'"""Synthetic module {index}."""', 'import os']
+            lines += [f"import {str(Path(i).with_suffix('')).replace('/', '.')}" for i in imports]
+            lines.append(f"\nLIMIT_{index} = {rng.randint(10, 1000)}\n")
+            for f in range(count):
+                lines.append(f'''
+def function_{f}(value, scale={f + 1}):
+    """Scale value and clamp it to LIMIT_{index}."""
+    result = value * scale
+    for step in range({rng.randint(2, 9)}):
+        result = result + step if result < LIMIT_{index} else result - step
+    if result > LIMIT_{index}:
+        raise ValueError("value out of range")
+    return result
+''')
+        else:
+            path = package / f"{name}.js"
+            lines = []
+            for i in imports:
+                relative = os.path.relpath(Path(i).with_suffix(''), package).replace(os.sep, '/')
+                if not relative.startswith('.'):
+                    relative = f"./{relative}"
+                lines.append(f"const dep{len(lines)} = require('{relative}');")
+            lines.append(f"\nconst LIMIT = {rng.randint(10, 1000)};\n")
+            for f in range(count):
+                lines.append(f'''
+/** Scale value and clamp it to LIMIT. */
+function function{f}(value, scale = {f + 1}) {{
+  let result = value * scale;
+  for (let step = 0; step < {rng.randint(2, 9)}; step++) {{
+    result = result < LIMIT ? result + step : result - step;
+  }}
+  if (result > LIMIT) {{
+    throw new Error('value out of range');
+  }}
+  return result;
+}}
+''')
+            lines.append(f"module.exports = {{ {', '.join(f'function{f}' for f in range(count))} }};")
+
+        (root / path).parent.mkdir(parents=True, exist_ok=True)
+        (root / path).write_text('\n'.join(lines) + '\n')
+        sources.append(path.as_posix())
+
+    tests_dir = root / 'tests'
+    tests_dir.mkdir(exist_ok=True)
+    for index in range(tests):
+        target = rng.choice(sources)
+        stem = Path(target).stem
+        if target.endswith('.py'):
+            module = str(Path(target).with_suffix('')).replace('/', '.')
+            (tests_dir / f"test_{stem}_{index}.py").write_text(
+                f"from {module} import function_0\n\n\ndef test_function_0():\n    assert function_0(1) == 1\n"
+            )
+        else:
+            relative = f"../{Path(target).with_suffix('').as_posix()}"
+            (tests_dir / f"{stem}_{index}.test.js").write_text(
+                f"const {{ function0 }} = require('{relative}');\n\n"
+                f"test('function0', () => {{\n  expect(function0(1)).toBe(1);\n}});\n"
+            )
+    return sources
+
+
+def make_generator(argv: List[str]) -> generate_tests.TestGenerator:
+    os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+    return generate_tests.TestGenerator(generate_tests.parse_args(argv))
+
+
+def bench_prompts(root: Path, sources: List[str], budget: int) -> Dict[str, int]:
+    """Compare prompt sizes without a token budget and with the given one."""
+    previous = os.getcwd()
+    os.chdir(root)
+    try:
+        unbounded = make_generator(['--prompt-tokens', '0', '--cache-dir', '.bench_cache'])
+        bounded = make_generator(['--prompt-tokens', str(budget), '--cache-dir', '.bench_cache'])
+        before = after = 0
+        for source in sources:
+            language = unbounded.detect_language(source)
+            before += generate_tests.estimate_tokens(unbounded.create_prompt(source, language) or '')
+            after += generate_tests.estimate_tokens(bounded.create_prompt(source, language) or '')
+    finally:
+        os.chdir(previous)
+    return {'files': len(sources), 'tokens_before': before, 'tokens_after': after}
+
+
+def read_io_counters() -> Dict[str, int]:
+    """Syscall and I/O counters of this process, from /proc/self/io where available."""
+    try:
+        with open('/proc/self/io', 'r') as f:
+            return {key: int(value) for key, value in (line.split(':') for line in f if ':' in line)}
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return {}
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {'inblock': usage.ru_inblock, 'oublock': usage.ru_oublock}
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of a list of values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def bench_run(root: Path, sources: List[str], args: argparse.Namespace) -> Dict[str, float]:
+    """Run TestGenerator end-to-end on a synthetic repo against a local mock completions server."""
+    server = MockCompletionsServer(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                                   error_status=args.error_status, chunk_size=args.chunk_size,
+                                   chunk_delay=args.chunk_delay, seed=args.seed, slow_rate=args.slow_rate,
+                                   slow_latency=args.slow_latency)
+    server.start()
+    previous_env = {name: os.environ.get(name) for name in ('OPENAI_API_KEY', 'OPENAI_API_BASE')}
+    os.environ['OPENAI_API_KEY'] = 'benchmark'
+    os.environ['OPENAI_API_BASE'] = server.api_base
+    previous = os.getcwd()
+    os.chdir(root)
+    try:
+        argv = ['--workers', str(args.workers), '--no-coverage', '--cache-dir', '.bench_cache',
+                '--max-retries', str(args.max_retries)]
+        if not args.cache:
+            argv.append('--no-cache')
+        if args.stream:
+            argv.append('--stream')
+        if args.hedge:
+            argv += ['--hedge', '--hedge-delay', str(args.hedge_delay)]
+        generator = generate_tests.TestGenerator(generate_tests.parse_args(argv + sources))
+
+        io_before = read_io_counters()
+        start = time.perf_counter()
+        results = generator.run()
+        elapsed = time.perf_counter() - start
+        io_after = read_io_counters()
+    finally:
+        os.chdir(previous)
+        for name, value in previous_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        server.shutdown()
+        server.server_close()
+
+    latencies = [r.seconds for r in results if not r.skipped]
+    stats = generator.client.stats()
+    report = {
+        'files': len(results),
+        'generated': sum(1 for r in results if r.test_file),
+        'seconds': round(elapsed, 4),
+        'files_per_sec': round(len(results) / elapsed, 3) if elapsed else 0.0,
+        'p50_seconds': round(percentile(latencies, 50), 4),
+        'p95_seconds': round(percentile(latencies, 95), 4),
+        'api_requests': server.request_count,
+        'injected_errors': server.error_count,
+        'retries': stats['retries'],
+        'slow_responses': server.slow_count,
+        'bytes_read': int(generator.metrics.counters.get('bytes_read', 0)),
+        'bytes_reused': int(generator.metrics.counters.get('bytes_reused', 0)),
+        'cached_prompt_tokens': int(generator.metrics.counters.get('cached_prompt_tokens', 0)),
+        'prompt_tokens': int(generator.metrics.counters.get('prompt_tokens', 0)),
+        'hedged_requests': int(generator.metrics.counters.get('hedged_requests', 0)),
+        'hedge_wins': int(generator.metrics.counters.get('hedge_wins', 0)),
+        'reused_connections': stats['reused_connections']
+    }
+    for key, value in io_after.items():
+        report[f"io_{key}"] = value - io_before.get(key, 0)
+    return report
+
+
+def bench_shards(root: Path, sources: List[str], args: argparse.Namespace) -> Dict[str, float]:
+    """Run generate_tests.py as --shards processes, each in its own copy of the repo, and merge their outputs.
+
+    The same files are also processed by a single unsharded process, for
+    the speedup and to check that the merged output has the same test files.
+    The repo starts with committed tests for every source file, as on CI, so
+    a shard's unchanged copies must not overwrite what another shard wrote.
+    """
+    server = MockCompletionsServer(latency=args.latency, jitter=args.jitter, seed=args.seed,
+                                   latency_per_1k_tokens=args.latency_per_1k_tokens)
+    server.start()
+    env = dict(os.environ, OPENAI_API_KEY='benchmark', OPENAI_API_BASE=server.api_base)
+    script = str(Path(generate_tests.__file__).resolve())
+    work = root.parent / 'shards'
+    for source in sources + ['unrelated.py']:
+        language = 'javascript' if source.endswith('.js') else 'python'
+        committed = root / 'generated_tests' / language / f"test_{Path(source).stem}{Path(source).suffix}"
+        committed.parent.mkdir(parents=True, exist_ok=True)
+        committed.write_text("# Committed by an earlier run\n")
+    names = ['single', 'merged'] + [f"shard-{i}" for i in range(1, args.shards + 1)]
+    for name in names:
+        shutil.copytree(root, work / name)
+
+    def launch(name: str, extra: List[str]) -> subprocess.Popen:
+        workdir = work / name
+        command = [sys.executable, script, '--workers', str(args.workers), '--no-coverage', '--no-cache',
+                   *extra, ' '.join(sources)]
+        return subprocess.Popen(command, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        start = time.perf_counter()
+        single = launch('single', [])
+        single.wait()
+        single_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        shards = [launch(f"shard-{i}", ['--shard', f"{i}/{args.shards}"]) for i in range(1, args.shards + 1)]
+        failed = sum(1 for shard in shards if shard.wait() != 0)
+        sharded_seconds = time.perf_counter() - start
+
+        merged = work / 'merged'
+        subprocess.run([sys.executable, script, '--merge', '--metrics-json', 'merged.json',
+                        *[str(work / f"shard-{i}") for i in range(1, args.shards + 1)]],
+                       cwd=merged, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        with open(merged / 'merged.json', 'r') as f:
+            report = json.load(f)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    def outputs(directory: Path) -> Dict[str, bytes]:
+        tests_dir = directory / 'generated_tests'
+        return {p.relative_to(tests_dir).as_posix(): p.read_bytes() for p in tests_dir.rglob('*') if p.is_file()}
+
+    costs = [shard.get('cost', 0) for shard in report['shards']]
+    return {
+        'files': len(sources),
+        'shards': args.shards,
+        'failed_shards': failed,
+        'single_seconds': round(single_seconds, 4),
+        'sharded_seconds': round(sharded_seconds, 4),
+        'speedup': round(single_seconds / sharded_seconds, 3) if sharded_seconds else 0.0,
+        'shard_seconds': [shard['duration_seconds'] for shard in report['shards']],
+        'shard_files': [shard.get('files', 0) for shard in report['shards']],
+        'slowest_over_mean': report['balance']['slowest_over_mean'],
+        'costliest_over_mean': round(max(costs) * len(costs) / sum(costs), 3) if sum(costs) else 1.0,
+        'merged_files': report['files'].get('generated', 0),
+        'outputs_match': outputs(work / 'single') == outputs(merged)
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=Path(__file__).resolve().parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def store_result(results_file: Path, config: dict, result: dict) -> Optional[dict]:
+    """Append a result to the results file and return the previous result for the same config."""
+    previous = None
+    try:
+        with open(results_file, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('config') == config:
+                    previous = record
+    except OSError:
+        pass
+
+    results_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(results_file, 'a') as f:
+        f.write(json.dumps({'commit': git_commit(), 'timestamp': time.time(),
+                            'config': config, 'result': result}) + '\n')
+    return previous
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for generate_tests.py")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_repo_options(subparser):
+        subparser.add_argument('--files', type=int, default=50, help="Source files in the synthetic repo")
+        subparser.add_argument('--import-depth', type=int, default=3, help="Package depth and imports per module")
+        subparser.add_argument('--tests', type=int, default=20, help="Existing test files in the synthetic repo")
+        subparser.add_argument('--functions', type=int, default=8, help="Functions per module")
+        subparser.add_argument('--language', choices=['python', 'javascript', 'both'], default='python')
+        subparser.add_argument('--seed', type=int, default=0)
+        subparser.add_argument('--size-skew', type=float, default=0.0,
+                               help="Spread of module sizes (log-normal sigma), 0 for equal sizes")
+
+    prompt_parser = subparsers.add_parser('prompt', help="Prompt size before and after token budgeting")
+    add_repo_options(prompt_parser)
+    prompt_parser.add_argument('--budget', type=int, default=2000, help="Prompt token budget to compare against")
+
+    run_parser = subparsers.add_parser('run', help="End-to-end run against a mock completions server")
+    add_repo_options(run_parser)
+    run_parser.add_argument('--workers', type=int, default=4)
+    run_parser.add_argument('--stream', action='store_true', help="Use streaming completions")
+    run_parser.add_argument('--cache', action='store_true', help="Keep the response cache enabled")
+    run_parser.add_argument('--max-retries', type=int, default=3)
+    run_parser.add_argument('--latency', type=float, default=0.2, help="Mock server latency in seconds")
+    run_parser.add_argument('--jitter', type=float, default=0.05, help="Random +/- seconds added to the latency")
+    run_parser.add_argument('--error-rate', type=float, default=0.0, help="Share of requests failing")
+    run_parser.add_argument('--error-status', type=int, default=503)
+    run_parser.add_argument('--chunk-size', type=int, default=16, help="Characters per streamed event")
+    run_parser.add_argument('--chunk-delay', type=float, default=0.0, help="Seconds between streamed events")
+    run_parser.add_argument('--slow-rate', type=float, default=0.0, help="Share of requests with tail latency")
+    run_parser.add_argument('--slow-latency', type=float, default=5.0, help="Mock server tail latency in seconds")
+    run_parser.add_argument('--hedge', action='store_true', help="Hedge requests slower than --hedge-delay")
+    run_parser.add_argument('--hedge-delay', type=float, default=1.0, help="Hedging deadline in seconds")
+    run_parser.add_argument('--results-file', type=Path, default=RESULTS_FILE,
+                            help="JSON lines file that results are appended to and compared against")
+    run_parser.add_argument('--regression-threshold', type=float, default=10.0,
+                            help="Percent drop in files/sec reported as a regression")
+
+    shard_parser = subparsers.add_parser('shard', help="Sharded run in separate processes, merged and checked")
+    add_repo_options(shard_parser)
+    shard_parser.add_argument('--shards', type=int, default=4)
+    shard_parser.add_argument('--workers', type=int, default=2, help="Workers per shard process")
+    shard_parser.add_argument('--latency', type=float, default=0.1, help="Mock server latency in seconds")
+    shard_parser.add_argument('--latency-per-1k-tokens', type=float, default=0.05,
+                              help="Extra mock server latency per 1000 prompt tokens")
+    shard_parser.add_argument('--jitter', type=float, default=0.0, help="Random +/- seconds added to the latency")
+    shard_parser.set_defaults(size_skew=1.0)
+
+    args = parser.parse_args(argv)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory(prefix='testgen-bench-') as tmp:
+        root = Path(tmp) / 'repo'
+        sources = make_synthetic_repo(root, args.files, args.import_depth, args.tests,
+                                      args.functions, args.language, args.seed, args.size_skew)
+        if args.command == 'prompt':
+            result = bench_prompts(root, sources, args.budget)
+            saved = result['tokens_before'] - result['tokens_after']
+            print(f"Prompts for {result['files']} files: {result['tokens_before']} tokens before, "
+                  f"{result['tokens_after']} after a {args.budget} token budget "
+                  f"({saved} saved, {saved * 100 / max(1, result['tokens_before']):.1f}%)")
+            return 0
+
+        if args.command == 'shard':
+            result = bench_shards(root, sources, args)
+            for key, value in result.items():
+                print(f"{key:>22}: {value}")
+            return 0 if result['outputs_match'] and not result['failed_shards'] else 1
+
+        result = bench_run(root, sources, args)
+
+    for key, value in result.items():
+        print(f"{key:>22}: {value}")
+
+    config = {name: value for name, value in vars(args).items() if name not in ('results_file', 'regression_threshold')}
+    previous = store_result(args.results_file, config, result)
+    if previous:
+        before = previous['result']['files_per_sec']
+        change = (result['files_per_sec'] - before) * 100 / before if before else 0.0
+        print(f"Compared with {previous.get('commit') or 'previous run'}: files/sec {before} -> "
+              f"{result['files_per_sec']} ({change:+.1f}%), p95 {previous['result']['p95_seconds']}s -> "
+              f"{result['p95_seconds']}s")
+        if change < -args.regression_threshold:
+            print(f"Regression: files/sec dropped by more than {args.regression_threshold}%")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,15 @@
 import random
 import time
+import argparse
+from typing import Callable, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # Only the question bank and the simulation need NumPy
+    np = None
+
+OPERATIONS = ['+', '-', '*', '/']
+MAX_OPERAND = 10
 
 def ask_question():
     """Ask a random math question and return the question and correct answer."""
@@ -65,5 +75,198 @@ def play_game():
             print(f"Game Over! Your final score is {score}.")
             break
 
+def require_numpy():
+    if np is None:
+        raise ImportError("The question bank needs NumPy; install it with 'pip install numpy'.")
+
+
+_division_table = None
+
+
+def division_table():
+    """Answers to every division question, rounded by Python's round() exactly as ask_question does."""
+    global _division_table
+    if _division_table is None:
+        require_numpy()
+        _division_table = np.array([[round(num1 / num2, 2) for num2 in range(1, MAX_OPERAND + 1)]
+                                    for num1 in range(1, MAX_OPERAND + 1)])
+    return _division_table
+
+
+class QuestionBank:
+    """A batch of questions held as NumPy arrays of operands, operator indices and answers."""
+
+    def __init__(self, num1, num2, operations, answers):
+        self.num1 = num1
+        self.num2 = num2
+        self.operations = operations
+        self.answers = answers
+
+    def __len__(self) -> int:
+        return len(self.answers)
+
+    def question(self, index: int) -> Tuple[str, float]:
+        """Return one question and its answer in the same form as ask_question."""
+        operation = OPERATIONS[self.operations[index]]
+        answer = float(self.answers[index])
+        if operation != '/':
+            answer = int(answer)
+        return f"What is {self.num1[index]} {operation} {self.num2[index]}?", answer
+
+
+def generate_questions(count: int, seed=None) -> QuestionBank:
+    """Generate count questions at once.
+
+    seed may be an int for a reproducible bank or a numpy Generator to keep
+    drawing from.
+    """
+    require_numpy()
+    rng = np.random.default_rng(seed)
+    num1 = rng.integers(1, MAX_OPERAND + 1, size=count)
+    num2 = rng.integers(1, MAX_OPERAND + 1, size=count)
+    operations = rng.integers(0, len(OPERATIONS), size=count, dtype=np.int8)
+    answers = np.select(
+        [operations == 0, operations == 1, operations == 2],
+        [num1 + num2, num1 - num2, num1 * num2],
+        division_table()[num1 - 1, num2 - 1]
+    )
+    return QuestionBank(num1, num2, operations, answers)
+
+
+# An answer provider stands in for the player: given a question bank and a
+# Generator it returns the answers (NaN for input that is not a number) and
+# the seconds taken to give each one, which must be positive so games end.
+AnswerProvider = Callable[[QuestionBank, "np.random.Generator"], Tuple["np.ndarray", "np.ndarray"]]
+
+
+def perfect_player(seconds: float = 1.0) -> AnswerProvider:
+    """A player who always answers correctly after a fixed number of seconds."""
+    if seconds <= 0:
+        raise ValueError(f"seconds must be positive, got {seconds}")
+
+    def provide(bank, rng):
+        return bank.answers.astype(float), np.full(len(bank), float(seconds))
+    return provide
+
+
+def noisy_player(accuracy: float = 0.95, mean_seconds: float = 1.5, invalid_rate: float = 0.0) -> AnswerProvider:
+    """A player who is right with the given probability and takes exponentially distributed time to answer."""
+    if mean_seconds <= 0:
+        raise ValueError(f"mean_seconds must be positive, got {mean_seconds}")
+
+    def provide(bank, rng):
+        count = len(bank)
+        answers = np.where(rng.random(count) < accuracy, bank.answers, bank.answers + 1).astype(float)
+        answers[rng.random(count) < invalid_rate] = np.nan
+        # The exponential distribution can return exactly 0
+        return answers, np.maximum(rng.exponential(mean_seconds, count), np.finfo(float).tiny)
+    return provide
+
+
+def check_answer_times(seconds):
+    """Reject answers that take no time, which would never run a game's clock out."""
+    if not (seconds > 0).all():
+        raise ValueError("answer providers must take a positive number of seconds per answer")
+
+
+class SimulatedClock:
+    """Stands in for time.time in headless games: time only moves when it is advanced."""
+
+    def __init__(self, start: float = 0.0):
+        self.now = start
+
+    def time(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+def play_headless(answer_provider: AnswerProvider, seed=None, clock: Optional[SimulatedClock] = None,
+                  game_duration: float = 30) -> int:
+    """Play one game like play_game, without a terminal, and return the final score."""
+    require_numpy()
+    rng = np.random.default_rng(seed)
+    clock = clock or SimulatedClock()
+    score = 0
+    start_time = clock.time()
+
+    while True:
+        if clock.time() - start_time > game_duration:
+            return score
+
+        bank = generate_questions(1, rng)
+        answers, seconds = answer_provider(bank, rng)
+        check_answer_times(seconds)
+        clock.advance(float(seconds[0]))
+
+        if np.isnan(answers[0]):
+            continue
+        if answers[0] == bank.answers[0]:
+            score += 1
+        else:
+            return score
+
+
+def simulate_games(games: int, answer_provider: AnswerProvider, seed=None, game_duration: float = 30,
+                   block: int = 16) -> Tuple["np.ndarray", "np.ndarray"]:
+    """Play many headless games at once and return each game's score and number of rounds.
+
+    Games still running are advanced block rounds at a time, with the same
+    rules as play_game: a question is asked while no more than game_duration
+    seconds have passed, a wrong answer ends the game and invalid input
+    skips the question.
+    """
+    require_numpy()
+    rng = np.random.default_rng(seed)
+    scores = np.zeros(games, dtype=np.int64)
+    rounds = np.zeros(games, dtype=np.int64)
+    elapsed = np.zeros(games)
+    running = np.arange(games)
+    columns = np.arange(block)
+
+    while running.size:
+        bank = generate_questions(running.size * block, rng)
+        answers, seconds = answer_provider(bank, rng)
+        check_answer_times(seconds)
+        answers = answers.reshape(running.size, block)
+        seconds = seconds.reshape(running.size, block)
+        finished_at = elapsed[running, None] + np.cumsum(seconds, axis=1)
+        asked = finished_at - seconds <= game_duration
+
+        correct = answers == bank.answers.reshape(running.size, block)
+        wrong = asked & ~correct & ~np.isnan(answers)
+        lost = wrong.any(axis=1)
+        last_round = np.where(lost, wrong.argmax(axis=1), block)
+        played = asked & (columns <= last_round[:, None])
+
+        scores[running] += (played & correct).sum(axis=1)
+        rounds[running] += played.sum(axis=1)
+        elapsed[running] = finished_at[:, -1]
+        running = running[~lost & asked[:, -1]]
+
+    return scores, rounds
+
+
+def run_simulation(games: int, accuracy: float, mean_seconds: float, seed=None):
+    """Simulate games with noisy players and report the scores and rounds per second."""
+    start = time.perf_counter()
+    scores, rounds = simulate_games(games, noisy_player(accuracy, mean_seconds), seed=seed)
+    elapsed = time.perf_counter() - start
+    print(f"Simulated {games} games, {int(rounds.sum())} rounds in {elapsed:.2f}s "
+          f"({rounds.sum() / elapsed:,.0f} rounds/s)")
+    print(f"Scores: mean {scores.mean():.2f}, median {np.median(scores):.0f}, best {scores.max()}")
+
+
 if __name__ == "__main__":
-    play_game()
+    parser = argparse.ArgumentParser(description="Play the calculator game, or simulate it headlessly.")
+    parser.add_argument('--simulate', type=int, metavar='GAMES', help="Simulate GAMES games instead of playing")
+    parser.add_argument('--accuracy', type=float, default=0.95, help="Share of questions simulated players get right")
+    parser.add_argument('--seconds', type=float, default=1.5, help="Mean seconds simulated players take per answer")
+    parser.add_argument('--seed', type=int, help="Seed for reproducible simulations")
+    args = parser.parse_args()
+
+    if args.simulate:
+        run_simulation(args.simulate, args.accuracy, args.seconds, seed=args.seed)
+    else:
+        play_game()
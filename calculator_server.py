@@ -0,0 +1,344 @@
+import sys
+import time
+import random
+import asyncio
+import logging
+import argparse
+from typing import Dict, List, Optional, Tuple
+
+from calculator import ask_question
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+GAME_DURATION = 30  # Seconds per session, as in play_game
+
+
+class Leaderboard:
+    """Best score per player, ranked with a Fenwick tree of how many players hold each score.
+
+    Submitting a score, looking up a player's rank and finding the k-th best
+    score all take O(log n) in the highest score seen; top(k) takes
+    O(k log n). Players with equal scores share a rank and are listed in
+    the order they reached it.
+    """
+
+    def __init__(self, capacity: int = 128):
+        self.tree = [0] * (capacity + 1)
+        self.best: Dict[str, int] = {}
+        self.holders: Dict[int, Dict[str, None]] = {}
+
+    def __len__(self) -> int:
+        return len(self.best)
+
+    def _add(self, score: int, delta: int):
+        index = score + 1
+        while index < len(self.tree):
+            self.tree[index] += delta
+            index += index & -index
+
+    def _count_at_most(self, score: int) -> int:
+        index, total = min(score + 1, len(self.tree) - 1), 0
+        while index > 0:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+
+    def _grow(self, score: int):
+        capacity = len(self.tree) - 1
+        while capacity <= score:
+            capacity *= 2
+        self.tree = [0] * (capacity + 1)
+        for held, names in self.holders.items():
+            self._add(held, len(names))
+
+    def _kth_lowest(self, k: int) -> int:
+        """Score of the k-th lowest entry (1-based), by binary lifting over the tree."""
+        index, step = 0, 1 << (len(self.tree) - 1).bit_length()
+        while step:
+            if index + step < len(self.tree) and self.tree[index + step] < k:
+                index += step
+                k -= self.tree[index]
+            step >>= 1
+        return index
+
+    def submit(self, name: str, score: int) -> int:
+        """Record a finished game and return the player's rank."""
+        previous = self.best.get(name)
+        if previous is None or score > previous:
+            if score >= len(self.tree) - 1:
+                self._grow(score)
+            if previous is not None:
+                self._add(previous, -1)
+                del self.holders[previous][name]
+                if not self.holders[previous]:
+                    del self.holders[previous]
+            self._add(score, 1)
+            self.holders.setdefault(score, {})[name] = None
+            self.best[name] = score
+        return self.rank(name)
+
+    def rank(self, name: str) -> Optional[int]:
+        """1 + the number of players with a higher best score, or None for unknown players."""
+        score = self.best.get(name)
+        if score is None:
+            return None
+        return len(self.best) - self._count_at_most(score) + 1
+
+    def top(self, k: int) -> List[Tuple[str, int]]:
+        """The k best players and their scores, best first."""
+        entries: List[Tuple[str, int]] = []
+        position = len(self.best)
+        while len(entries) < k and position > 0:
+            score = self._kth_lowest(position)
+            names = list(self.holders[score])
+            entries.extend((name, score) for name in names[:k - len(entries)])
+            position -= len(names)
+        return entries
+
+
+class GameServer:
+    """Hosts the calculator game for many players over a line protocol.
+
+    A client sends one command line:
+      PLAY <name>   play a game; the server sends questions, one per line,
+                    and the client answers each one with a line of its own
+      TOP [k]       the k best players, one "<rank> <name> <score>" per line
+      RANK <name>   the player's rank and best score
+    The connection is closed once the command is done. Each game ends at a
+    deadline on the event loop clock, even while waiting for an answer.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, game_duration: float = GAME_DURATION):
+        self.host = host
+        self.port = port
+        self.game_duration = game_duration
+        self.leaderboard = Leaderboard()
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logging.info(f"Calculator game server listening on {self.host}:{self.port}")
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            command, _, argument = (await reader.readline()).decode('utf-8', 'replace').strip().partition(' ')
+            command, argument = command.upper(), argument.strip()
+            if command == 'PLAY' and argument:
+                await self.play(argument, reader, writer)
+            elif command == 'TOP':
+                limit = int(argument) if argument.isdigit() else 10
+                for name, score in self.leaderboard.top(limit):
+                    writer.write(f"{self.leaderboard.rank(name)} {name} {score}\n".encode('utf-8'))
+            elif command == 'RANK' and argument:
+                rank = self.leaderboard.rank(argument)
+                if rank is None:
+                    writer.write(f"No games played by {argument}.\n".encode('utf-8'))
+                else:
+                    writer.write(f"{argument} is ranked {rank} of {len(self.leaderboard)} "
+                                 f"with {self.leaderboard.best[argument]} points.\n".encode('utf-8'))
+            else:
+                writer.write(b"Unknown command. Use PLAY <name>, TOP [k] or RANK <name>.\n")
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logging.debug(f"Client disconnected: {e}")
+        finally:
+            writer.close()
+
+    async def play(self, name: str, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Run one game with play_game's rules and record the score on the leaderboard."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.game_duration
+        score = 0
+
+        def send(line: str):
+            writer.write(f"{line}\n".encode('utf-8'))
+
+        send(f"Welcome to the Calculator Game, {name}!")
+        send(f"You have {self.game_duration:g} seconds to answer as many questions as possible.")
+        while True:
+            question, correct_answer = ask_question()
+            send(question)
+            await writer.drain()
+
+            try:
+                line = await asyncio.wait_for(reader.readline(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                send(f"Time's up! You scored {score} points!")
+                break
+            if not line:
+                logging.debug(f"{name} left the game with {score} points")
+                return
+
+            try:
+                player_answer = float(line)
+            except ValueError:
+                send("Invalid input! Please enter a number.")
+                continue
+
+            if player_answer == correct_answer:
+                score += 1
+                send(f"Correct! Your score is: {score}")
+            else:
+                send(f"Wrong! The correct answer was {correct_answer}.")
+                send(f"Game Over! Your final score is {score}.")
+                break
+
+        rank = self.leaderboard.submit(name, score)
+        send(f"Your rank is {rank} of {len(self.leaderboard)}.")
+
+    async def serve_forever(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+
+def answer_question(question: str) -> float:
+    """Solve a "What is a op b?" question with the same rules as ask_question."""
+    num1, operation, num2 = question[len("What is "):-1].split()
+    num1, num2 = int(num1), int(num2)
+    if operation == '+':
+        return num1 + num2
+    if operation == '-':
+        return num1 - num2
+    if operation == '*':
+        return num1 * num2
+    return round(num1 / num2, 2)
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def load_session(host: str, port: int, name: str, accuracy: float, think_time: float,
+                       rng: random.Random, latencies: List[float]) -> Optional[int]:
+    """Play one game as a bot and return its score, or None if the server ended it unexpectedly."""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(f"PLAY {name}\n".encode('utf-8'))
+        sent = time.perf_counter()
+        score = 0
+        while True:
+            line = (await reader.readline()).decode('utf-8')
+            if not line:
+                return None
+            line = line.strip()
+            if line.startswith("What is "):
+                latencies.append(time.perf_counter() - sent)
+                answer = answer_question(line)
+                if rng.random() >= accuracy:
+                    answer += 1
+                if think_time:
+                    await asyncio.sleep(rng.expovariate(1 / think_time))
+                writer.write(f"{answer}\n".encode('utf-8'))
+                sent = time.perf_counter()
+            elif line.startswith("Correct! Your score is: "):
+                score = int(line.rsplit(' ', 1)[1])
+            elif line.startswith("Your rank is"):
+                return score
+    finally:
+        writer.close()
+
+
+async def run_load(sessions: int, concurrency: int, accuracy: float, think_time: float,
+                   host: Optional[str] = None, port: Optional[int] = None,
+                   game_duration: float = GAME_DURATION, seed: Optional[int] = None) -> dict:
+    """Play sessions games, concurrency at a time, and report throughput and answer latency.
+
+    Without a host and port an in-process server with game_duration second
+    games is started and load-tested.
+    """
+    server = None
+    if host is None or port is None:
+        server = GameServer(game_duration=game_duration)
+        await server.start()
+        host, port = server.host, server.port
+
+    rng = random.Random(seed)
+    latencies: List[float] = []
+    scores: List[int] = []
+    failures = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def session(index: int):
+        nonlocal failures
+        async with semaphore:
+            try:
+                score = await load_session(host, port, f"bot{index}", accuracy, think_time, rng, latencies)
+            except OSError as e:
+                logging.debug(f"Session {index} failed: {e}")
+                score = None
+            if score is None:
+                failures += 1
+            else:
+                scores.append(score)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(session(index) for index in range(sessions)))
+    elapsed = time.perf_counter() - start
+
+    if server:
+        await server.close()
+    return {
+        'sessions': sessions,
+        'failures': failures,
+        'seconds': round(elapsed, 3),
+        'sessions_per_second': round(len(scores) / elapsed, 1),
+        'answers_per_second': round(len(latencies) / elapsed, 1),
+        'latency_p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'latency_p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'mean_score': round(sum(scores) / len(scores), 2) if scores else 0.0,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Multi-player server for the calculator game")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help="Host the game")
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8765)
+    serve_parser.add_argument('--duration', type=float, default=GAME_DURATION, help="Seconds per game")
+
+    load_parser = subparsers.add_parser('load', help="Simulate many players and report throughput and latency")
+    load_parser.add_argument('--host', help="Server to load-test; by default one is started in-process")
+    load_parser.add_argument('--port', type=int)
+    load_parser.add_argument('--sessions', type=int, default=2000)
+    load_parser.add_argument('--concurrency', type=int, default=200, help="Sessions played at the same time")
+    load_parser.add_argument('--accuracy', type=float, default=0.95, help="Share of questions the bots get right")
+    load_parser.add_argument('--think-time', type=float, default=0.0, help="Mean seconds bots take per answer")
+    load_parser.add_argument('--duration', type=float, default=GAME_DURATION,
+                             help="Seconds per game on the in-process server")
+    load_parser.add_argument('--seed', type=int)
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        server = GameServer(args.host, args.port, args.duration)
+        try:
+            asyncio.run(server.serve_forever())
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    report = asyncio.run(run_load(args.sessions, args.concurrency, args.accuracy, args.think_time,
+                                  host=args.host, port=args.port, game_duration=args.duration, seed=args.seed))
+    for key, value in report.items():
+        print(f"{key}: {value}")
+    return 0 if not report['failures'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
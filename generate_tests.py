@@ -1,11 +1,35 @@
 import subprocess
 import requests
 import os
+import re
 import sys
+import ast
+import json
+import time
+import copy
+import heapq
+import cProfile
+import hashlib
+import tempfile
+import functools
+import importlib.util
+import random
+import shutil
+import stat
 import logging
+import socket
+import argparse
+import threading
+import socketserver
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
 from pathlib import Path
-from requests.exceptions import RequestException
-from typing import List, Optional
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, RequestException, Timeout
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 # Set up logging
 logging.basicConfig(
@@ -13,10 +37,1684 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+
+def env_int(name: str, default: int) -> int:
+    """Read an integer setting from the environment, falling back to the default."""
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        logging.error(f"Invalid value for {name}. Using default value: {default}")
+        return default
+
+
+def env_float(name: str, default: float) -> float:
+    """Read a float setting from the environment, falling back to the default."""
+    try:
+        return float(os.getenv(name, str(default)))
+    except ValueError:
+        logging.error(f"Invalid value for {name}. Using default value: {default}")
+        return default
+
+
+def estimate_tokens(text: str) -> int:
+    """Roughly estimate the number of tokens in a piece of text (~4 characters per token)."""
+    return (len(text) + 3) // 4
+
+
+JS_DECLARATION_PATTERN = re.compile(
+    r'^\s*(export\s+)?(default\s+)?(async\s+)?(function\*?|class|interface|type|enum|const|let|var)\b'
+    r'|^\s*(static\s+|async\s+|get\s+|set\s+)*(?!(if|for|while|switch|catch|with)\b)[A-Za-z_$][\w$]*\s*\([^;]*\)\s*{\s*$'
+)
+
+
+def extract_signatures(source: str, language: str) -> str:
+    """Reduce source code to its public signatures and docstrings.
+
+    Python is handled with ast, keeping decorators, def/class lines and
+    docstrings of public names. JavaScript/TypeScript keeps declaration
+    lines only. Other languages are returned unchanged.
+    """
+    if language in ('JavaScript', 'TypeScript'):
+        lines = [line.rstrip() for line in source.splitlines() if JS_DECLARATION_PATTERN.match(line)]
+        return '\n'.join(lines)
+    if language != 'Python':
+        return source
+
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return source
+    lines = source.splitlines()
+    output = []
+
+    def docstring_lines(node) -> List[str]:
+        body = getattr(node, 'body', None)
+        if (body and isinstance(body[0], ast.Expr) and isinstance(body[0].value, ast.Constant)
+                and isinstance(body[0].value.value, str)):
+            return lines[body[0].lineno - 1:body[0].end_lineno]
+        return []
+
+    def visit(nodes, indent: str):
+        for node in nodes:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                if node.name.startswith('_') and node.name != '__init__':
+                    continue
+                start = min([d.lineno for d in node.decorator_list] + [node.lineno])
+                header_end = max(node.lineno, node.body[0].lineno - 1)
+                output.extend(lines[start - 1:header_end])
+                output.extend(docstring_lines(node))
+                if isinstance(node, ast.ClassDef):
+                    before = len(output)
+                    visit(node.body, indent + '    ')
+                    if len(output) == before:
+                        output.append(f"{indent}    ...")
+                else:
+                    output.append(f"{indent}    ...")
+            elif isinstance(node, (ast.Assign, ast.AnnAssign)) and not indent:
+                targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+                if all(isinstance(t, ast.Name) and t.id.isupper() for t in targets):
+                    output.extend(lines[node.lineno - 1:node.end_lineno])
+
+    output.extend(docstring_lines(tree))
+    visit(tree.body, '')
+    return '\n'.join(output)
+
+
+DEFINITION_TYPES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+
+
+@dataclass
+class CodeUnit:
+    """A top-level function or class of a Python module."""
+    name: str
+    start: int
+    end: int
+    source: str
+
+
+def node_span(node: ast.AST) -> Tuple[int, int]:
+    """First and last line of a top-level statement, including decorators."""
+    start = min([d.lineno for d in getattr(node, 'decorator_list', [])] + [node.lineno])
+    return start, node.end_lineno
+
+
+def python_code_units(source: str) -> List[CodeUnit]:
+    """Top-level functions and classes of a Python module, in source order."""
+    lines = source.splitlines(keepends=True)
+    units = []
+    for node in ast.parse(source).body:
+        if isinstance(node, DEFINITION_TYPES):
+            start, end = node_span(node)
+            units.append(CodeUnit(node.name, start, end, ''.join(lines[start - 1:end])))
+    return units
+
+
+def python_module_header(source: str) -> str:
+    """Top-level imports, constants and other statements outside functions and classes."""
+    lines = source.splitlines(keepends=True)
+    header = []
+    for node in ast.parse(source).body:
+        if isinstance(node, DEFINITION_TYPES):
+            continue
+        if (isinstance(node, ast.If) and isinstance(node.test, ast.Compare)
+                and isinstance(node.test.left, ast.Name) and node.test.left.id == '__name__'):
+            continue
+        start, end = node_span(node)
+        header.append(''.join(lines[start - 1:end]).rstrip('\n'))
+    return '\n'.join(header)
+
+
+def plan_chunks(units: List[CodeUnit], max_tokens: int) -> List[List[CodeUnit]]:
+    """Group consecutive units into chunks of at most max_tokens; larger units get a chunk of their own."""
+    chunks: List[List[CodeUnit]] = []
+    size = 0
+    for unit in units:
+        tokens = estimate_tokens(unit.source)
+        if chunks and size + tokens <= max_tokens:
+            chunks[-1].append(unit)
+            size += tokens
+        else:
+            chunks.append([unit])
+            size = tokens
+    return chunks
+
+
+def merge_test_classes(existing: ast.ClassDef, lines: List[str], new: ast.ClassDef, new_lines: List[str]) -> str:
+    """Text of an existing test class with the members of a new class of the same name merged in.
+
+    Methods and nested classes replace the ones with the same name and new
+    ones are appended, re-indented to match the existing class. Other new
+    statements are appended unless already present; the new class's
+    docstring, decorators and bases are ignored.
+    """
+    start, end = node_span(existing)
+    class_lines = lines[start - 1:end]
+    indent = ' ' * existing.body[0].col_offset
+    new_indent = ' ' * new.body[0].col_offset
+
+    def member(source_lines: List[str], node: ast.AST) -> str:
+        first, last = node_span(node)
+        return ''.join(source_lines[first - 1:last]).rstrip('\n') + '\n'
+
+    existing_members = {node.name: node for node in existing.body if isinstance(node, DEFINITION_TYPES)}
+    existing_statements = {member(lines, node).strip() for node in existing.body
+                           if not isinstance(node, DEFINITION_TYPES)}
+    edits = []
+    appended: List[str] = []
+    for index, node in enumerate(new.body):
+        if (index == 0 and isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant)
+                and isinstance(node.value.value, str)) or isinstance(node, ast.Pass):
+            continue
+        text = ''.join(indent + line[len(new_indent):] if line.startswith(new_indent) else line
+                       for line in member(new_lines, node).splitlines(keepends=True))
+        if isinstance(node, DEFINITION_TYPES) and node.name in existing_members:
+            first, last = node_span(existing_members.pop(node.name))
+            edits.append((first - start, last - start + 1, text))
+        elif isinstance(node, DEFINITION_TYPES) or text.strip() not in existing_statements:
+            appended.append(text)
+    for first, last, text in sorted(edits, key=lambda edit: edit[0], reverse=True):
+        class_lines[first:last] = [text]
+
+    merged = ''.join(class_lines).rstrip('\n') + '\n'
+    for text in appended:
+        merged += '\n' + text
+    return merged
+
+
+def merge_test_modules(existing: str, new: str) -> str:
+    """Merge newly generated tests into an existing test module.
+
+    Imports missing from the existing module are added after its imports,
+    top-level functions replace the ones with the same name, classes that
+    exist in both modules have their members merged, and any other new
+    top-level statement is appended unless it is already present. Raises
+    SyntaxError if either module does not parse.
+    """
+    existing_tree = ast.parse(existing)
+    new_tree = ast.parse(new)
+    lines = existing.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+
+    def segment(source_lines: List[str], node: ast.AST) -> str:
+        start, end = node_span(node)
+        return ''.join(source_lines[start - 1:end]).rstrip('\n') + '\n'
+
+    existing_defs = {}
+    existing_statements = set()
+    import_anchor = 0
+    for index, node in enumerate(existing_tree.body):
+        if isinstance(node, DEFINITION_TYPES):
+            existing_defs[node.name] = node
+        else:
+            existing_statements.add(segment(lines, node).strip())
+            if not existing_defs and (isinstance(node, (ast.Import, ast.ImportFrom)) or index == 0):
+                import_anchor = node.end_lineno
+
+    # A name defined twice in the new module keeps its last definition
+    new_defs = {node.name: node for node in new_tree.body if isinstance(node, DEFINITION_TYPES)}
+    new_imports: List[str] = []
+    appended: List[str] = []
+    edits = []
+    for node in new_tree.body:
+        if isinstance(node, DEFINITION_TYPES):
+            node = new_defs.pop(node.name, None)
+            if node is None:
+                continue
+            current = existing_defs.get(node.name)
+            if current is None:
+                appended.append(segment(new_lines, node))
+                continue
+            start, end = node_span(current)
+            if isinstance(current, ast.ClassDef) and isinstance(node, ast.ClassDef):
+                text = merge_test_classes(current, lines, node, new_lines)
+            else:
+                text = segment(new_lines, node)
+            edits.append((start - 1, end, text))
+            continue
+        text = segment(new_lines, node)
+        if text.strip() in existing_statements or text in new_imports or text in appended:
+            continue
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            new_imports.append(text)
+        else:
+            appended.append(text)
+    if new_imports:
+        edits.append((import_anchor, import_anchor, ''.join(new_imports)))
+    for start, end, text in sorted(edits, key=lambda edit: edit[0], reverse=True):
+        lines[start:end] = [text]
+
+    merged = ''.join(lines).rstrip('\n') + '\n'
+    for text in appended:
+        merged += '\n\n' + text
+    return merged
+
+
+def format_line_ranges(lines: List[int]) -> str:
+    """Compress sorted line numbers into coverage-style ranges, e.g. '3-5, 9'."""
+    ranges = []
+    for line in lines:
+        if ranges and line == ranges[-1][1] + 1:
+            ranges[-1][1] = line
+        else:
+            ranges.append([line, line])
+    return ', '.join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+
+# Read once at import: os.umask can only be queried by setting it, which is not thread-safe
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def replace_file(tmp_name: str, path: Path):
+    """Move a finished temporary file over path.
+
+    mkstemp creates files readable only by their owner, so the temporary
+    file first gets the mode of the file it replaces, or the mode open()
+    would have created it with.
+    """
+    try:
+        mode = stat.S_IMODE(path.stat().st_mode)
+    except OSError:
+        mode = 0o666 & ~UMASK
+    os.chmod(tmp_name, mode)
+    os.replace(tmp_name, path)
+
+
+def atomic_write_text(path: Path, text: str):
+    """Write a file through a temporary sibling and os.replace so readers never see partial content."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        replace_file(tmp_name, path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+def parse_shard(spec: str) -> Tuple[int, int]:
+    """Parse a shard given as 'i/N', with shards numbered from 1."""
+    try:
+        index, count = (int(part) for part in spec.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"shard must look like i/N, got {spec!r}")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"shard index must be between 1 and {count}, got {index}")
+    return index, count
+
+
+def partition_by_cost(costs: List[float], shards: int) -> List[int]:
+    """Assign items to shards with the longest-processing-time-first heuristic.
+
+    Items are taken from most to least expensive and each goes to the shard
+    with the lowest total so far. Ties are broken by position, so every shard
+    computes the same assignment from the same input.
+    """
+    assignment = [0] * len(costs)
+    loads = [(0.0, shard) for shard in range(shards)]
+    for item in sorted(range(len(costs)), key=lambda i: (-costs[i], i)):
+        load, shard = heapq.heappop(loads)
+        assignment[item] = shard
+        heapq.heappush(loads, (load + costs[item], shard))
+    return assignment
+
+
+def merge_reports(reports: List[dict]) -> dict:
+    """Combine the run reports of several shards into one report for the whole run."""
+    stages: Dict[str, dict] = {}
+    totals = {section: defaultdict(int) for section in ('counters', 'files', 'api', 'cache')}
+    per_file = []
+    shards = []
+    for report in reports:
+        for name, stage in (report.get('stages') or {}).items():
+            total = stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            total['calls'] += stage['calls']
+            total['seconds'] = round(total['seconds'] + stage['seconds'], 6)
+            total['max_seconds'] = max(total['max_seconds'], stage['max_seconds'])
+        for section, values in totals.items():
+            for name, value in (report.get(section) or {}).items():
+                values[name] += value
+        per_file += report.get('per_file') or []
+        shards.append(dict(report.get('shard') or {}, duration_seconds=report.get('duration_seconds', 0.0)))
+
+    durations = [shard['duration_seconds'] for shard in shards]
+    mean = sum(durations) / len(durations) if durations else 0.0
+    merged = {
+        'started': min(report.get('started', 0.0) for report in reports),
+        # Shards run side by side, so the run takes as long as the slowest one
+        'duration_seconds': max(durations, default=0.0),
+        'stages': dict(sorted(stages.items())),
+        **{section: dict(sorted(values.items())) for section, values in totals.items()},
+        'per_file': per_file,
+        'shards': shards,
+        'balance': {'slowest_over_mean': round(max(durations) / mean, 3) if mean else 1.0}
+    }
+    return merged
+
+
+def merge_shards(options: argparse.Namespace) -> int:
+    """Combine the outputs of shard runs, one directory per shard, into ./generated_tests and one run report.
+
+    Each directory holds what a shard left behind: its generated_tests/
+    and its --shard-output directory with the run report, coverage data and
+    a manifest of the files in generated_tests/ the shard wrote. Only those
+    files are copied, since the rest is the checkout's unchanged content. A
+    file written by two shards is an error.
+    """
+    shard_dirs = [Path(d) for arg in options.changed_files for d in arg.split()]
+    if not shard_dirs:
+        logging.error("No shard directories given to merge")
+        return 1
+
+    output_dir = Path('generated_tests')
+    copied: Dict[Path, Path] = {}
+    reports = []
+    coverage_files = []
+    failed = False
+    for shard_dir in shard_dirs:
+        tests_dir = shard_dir / 'generated_tests'
+        shard_output = shard_dir / options.shard_output
+        try:
+            with open(shard_output / 'manifest.json', 'r', encoding='utf-8') as f:
+                written = [Path(name) for name in json.load(f)['files']]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.error(f"No manifest of written files from shard {shard_dir}: {e}")
+            failed = True
+            written = []
+        for relative in written:
+            if relative in copied:
+                logging.error(f"{relative} was written by both {copied[relative]} and {shard_dir}")
+                failed = True
+                continue
+            target = output_dir / relative
+            target.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                shutil.copy2(tests_dir / relative, target)
+            except OSError as e:
+                logging.error(f"Could not copy {relative} from shard {shard_dir}: {e}")
+                failed = True
+                continue
+            copied[relative] = shard_dir
+
+        try:
+            with open(shard_output / 'metrics.json', 'r', encoding='utf-8') as f:
+                reports.append(json.load(f))
+        except (OSError, ValueError) as e:
+            logging.warning(f"No run report from shard {shard_dir}: {e}")
+        if (shard_output / 'coverage.data').exists():
+            coverage_files.append(str(shard_output / 'coverage.data'))
+    logging.info(f"Merged {len(copied)} files from {len(shard_dirs)} shards into {output_dir}")
+
+    if coverage_files:
+        omit = "--omit=*/site-packages/*"
+        try:
+            subprocess.run([sys.executable, '-m', 'coverage', 'combine', '--keep', *coverage_files], check=True)
+            subprocess.run([sys.executable, '-m', 'coverage', 'json', '-o', str(output_dir / 'coverage.json'), omit],
+                           check=True)
+            with open(output_dir / 'coverage_report.txt', 'w') as report:
+                subprocess.run([sys.executable, '-m', 'coverage', 'report', '-m', omit], stdout=report, check=True)
+            logging.info(f"Combined coverage of {len(coverage_files)} shards saved to {output_dir / 'coverage_report.txt'}")
+        except (OSError, subprocess.CalledProcessError) as e:
+            logging.error(f"Error combining shard coverage: {e}")
+
+    if reports:
+        report = merge_reports(reports)
+        files = report['files']
+        logging.info(f"Run summary: {files.get('total', 0)} files, {files.get('generated', 0)} generated, "
+                     f"{files.get('failed', 0)} failed, {files.get('skipped', 0)} skipped")
+        for shard in report['shards']:
+            logging.info(f"  shard {shard.get('index', '?')}/{shard.get('count', '?')}: {shard.get('files', '?')} files, "
+                         f"estimated cost {shard.get('cost', '?')}, {shard['duration_seconds']}s")
+        logging.info(f"Slowest shard took {report['balance']['slowest_over_mean']}x the mean")
+        try:
+            if options.metrics_json:
+                atomic_write_text(Path(options.metrics_json), json.dumps(report, indent=2))
+                logging.info(f"Merged run report saved to {options.metrics_json}")
+            if options.prometheus_file:
+                atomic_write_text(Path(options.prometheus_file), Metrics.format_prometheus(report))
+                logging.info(f"Prometheus metrics saved to {options.prometheus_file}")
+        except OSError as e:
+            logging.error(f"Error writing merged metrics: {e}")
+    return 1 if failed else 0
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse command-line options. Changed files may be passed as one space-separated string."""
+    parser = argparse.ArgumentParser(description="Generate unit tests for changed files using OpenAI.")
+    parser.add_argument('changed_files', nargs='*', default=[],
+                        help="Changed files, either as separate arguments or one space-separated string")
+    parser.add_argument('--workers', type=int, default=env_int('TESTGEN_WORKERS', 4),
+                        help="Number of files processed concurrently (env: TESTGEN_WORKERS)")
+    parser.add_argument('--requests-per-minute', type=int, default=env_int('OPENAI_RPM', 0),
+                        help="Maximum API requests per minute, 0 for unlimited (env: OPENAI_RPM)")
+    parser.add_argument('--tokens-per-minute', type=int, default=env_int('OPENAI_TPM', 0),
+                        help="Maximum API tokens per minute, 0 for unlimited (env: OPENAI_TPM)")
+    parser.add_argument('--pool-size', type=int, default=env_int('OPENAI_POOL_SIZE', 0),
+                        help="Keep-alive HTTP connections to the API, 0 to match --workers (env: OPENAI_POOL_SIZE)")
+    parser.add_argument('--max-retries', type=int, default=env_int('OPENAI_MAX_RETRIES', 3),
+                        help="Retries for 429/5xx responses and connection errors (env: OPENAI_MAX_RETRIES)")
+    parser.add_argument('--connect-timeout', type=float, default=env_float('OPENAI_CONNECT_TIMEOUT', 10.0),
+                        help="Seconds to wait for a connection (env: OPENAI_CONNECT_TIMEOUT)")
+    parser.add_argument('--read-timeout', type=float, default=env_float('OPENAI_READ_TIMEOUT', 60.0),
+                        help="Seconds to wait for a response (env: OPENAI_READ_TIMEOUT)")
+    parser.add_argument('--hedge', action='store_true', default=os.getenv('OPENAI_HEDGE', '') == '1',
+                        help="Send a duplicate of requests still running at the latency deadline and use "
+                             "whichever answers first (env: OPENAI_HEDGE=1)")
+    parser.add_argument('--hedge-percentile', type=float, default=env_float('OPENAI_HEDGE_PERCENTILE', 95.0),
+                        help="Latency percentile of the model used as the hedging deadline (env: OPENAI_HEDGE_PERCENTILE)")
+    parser.add_argument('--hedge-delay', type=float, default=env_float('OPENAI_HEDGE_DELAY', 20.0),
+                        help="Hedging deadline in seconds until enough latencies have been seen (env: OPENAI_HEDGE_DELAY)")
+    parser.add_argument('--fallback-model', default=os.getenv('OPENAI_FALLBACK_MODEL'),
+                        help="Model for hedged duplicates, e.g. a cheaper one; defaults to OPENAI_MODEL "
+                             "(env: OPENAI_FALLBACK_MODEL)")
+    parser.add_argument('--cache-dir', default=os.getenv('TESTGEN_CACHE_DIR', '.testgen_cache'),
+                        help="Directory for cached API responses (env: TESTGEN_CACHE_DIR)")
+    parser.add_argument('--cache-max-mb', type=int, default=env_int('TESTGEN_CACHE_MAX_MB', 256),
+                        help="Size limit of the response cache in megabytes (env: TESTGEN_CACHE_MAX_MB)")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Neither read nor write cached API responses")
+    parser.add_argument('--refresh', action='store_true',
+                        help="Ignore cached API responses but store the new ones")
+    parser.add_argument('--stream', action='store_true', default=os.getenv('OPENAI_STREAM', '') == '1',
+                        help="Stream completions and write tests as they arrive (env: OPENAI_STREAM=1)")
+    parser.add_argument('--max-output-bytes', type=int, default=env_int('TESTGEN_MAX_OUTPUT_BYTES', 200000),
+                        help="Abort a streamed completion larger than this (env: TESTGEN_MAX_OUTPUT_BYTES)")
+    parser.add_argument('--no-coverage', action='store_true',
+                        help="Skip coverage tool checks and coverage reports")
+    parser.add_argument('--coverage-jobs', type=int, default=env_int('TESTGEN_COVERAGE_JOBS', 1),
+                        help="Parallel pytest processes for the coverage run (env: TESTGEN_COVERAGE_JOBS)")
+    parser.add_argument('--metrics-json', default=os.getenv('TESTGEN_METRICS_JSON'),
+                        help="Write a JSON run report with stage timings and counters (env: TESTGEN_METRICS_JSON)")
+    parser.add_argument('--prometheus-file', default=os.getenv('TESTGEN_PROMETHEUS_FILE'),
+                        help="Write run metrics in Prometheus textfile format (env: TESTGEN_PROMETHEUS_FILE)")
+    parser.add_argument('--profile', default=os.getenv('TESTGEN_PROFILE'),
+                        help="Profile the local-only stages with cProfile and save the stats here "
+                             "(env: TESTGEN_PROFILE). Profiled stages run one at a time.")
+    parser.add_argument('--incremental', action='store_true', default=os.getenv('TESTGEN_INCREMENTAL', '') == '1',
+                        help="Only generate tests for Python functions and classes changed since --base-ref and "
+                             "merge them into the existing test file (env: TESTGEN_INCREMENTAL=1)")
+    parser.add_argument('--base-ref', default=os.getenv('TESTGEN_BASE_REF', 'HEAD^'),
+                        help="Git revision that --incremental diffs against (env: TESTGEN_BASE_REF)")
+    parser.add_argument('--chunk-tokens', type=int, default=env_int('TESTGEN_CHUNK_TOKENS', 6000),
+                        help="Split Python files larger than this many tokens into function/class chunks that are "
+                             "generated concurrently, 0 to disable (env: TESTGEN_CHUNK_TOKENS)")
+    parser.add_argument('--shard', type=parse_shard, default=os.getenv('TESTGEN_SHARD'),
+                        help="Only process shard i of N (given as i/N) of the changed files, balanced by "
+                             "estimated cost (env: TESTGEN_SHARD)")
+    parser.add_argument('--shard-output', default=os.getenv('TESTGEN_SHARD_OUTPUT', 'testgen-shard'),
+                        help="Where a shard leaves its run report and coverage data for --merge "
+                             "(env: TESTGEN_SHARD_OUTPUT)")
+    parser.add_argument('--merge', action='store_true',
+                        help="Merge shard outputs; the positional arguments are then one directory per shard")
+    parser.add_argument('--serve', action='store_true',
+                        help="Run as a daemon on --socket, keeping indexes, caches and connections warm")
+    parser.add_argument('--connect', action='store_true',
+                        help="Send the changed files to a running daemon instead of processing them here")
+    parser.add_argument('--stop', action='store_true', help="Ask a running daemon to shut down")
+    parser.add_argument('--socket', default=os.getenv('TESTGEN_SOCKET', os.path.join('.testgen_cache', 'daemon.sock')),
+                        help="Unix socket of the daemon (env: TESTGEN_SOCKET)")
+    parser.add_argument('--watch-interval', type=float, default=env_float('TESTGEN_WATCH_INTERVAL', 2.0),
+                        help="Seconds between daemon checks of the tree for changes (env: TESTGEN_WATCH_INTERVAL)")
+    parser.add_argument('--prompt-tokens', type=int, default=env_int('TESTGEN_PROMPT_TOKENS', 12000),
+                        help="Token budget for each prompt, 0 for unlimited (env: TESTGEN_PROMPT_TOKENS)")
+    parser.add_argument('--validate', action='store_true', default=os.getenv('TESTGEN_VALIDATE', '') == '1',
+                        help="Run generated Python tests and keep only those that pass, asking for repairs of "
+                             "failing ones (env: TESTGEN_VALIDATE=1)")
+    parser.add_argument('--repair-rounds', type=int, default=env_int('TESTGEN_REPAIR_ROUNDS', 2),
+                        help="Repair requests per failing test file before it is dropped (env: TESTGEN_REPAIR_ROUNDS)")
+    parser.add_argument('--test-timeout', type=float, default=env_float('TESTGEN_TEST_TIMEOUT', 30.0),
+                        help="Seconds each generated test may run during validation (env: TESTGEN_TEST_TIMEOUT)")
+    parser.add_argument('--validation-jobs', type=int, default=env_int('TESTGEN_VALIDATION_JOBS', 0),
+                        help="Test files validated in parallel; 0 uses --workers (env: TESTGEN_VALIDATION_JOBS)")
+    parser.add_argument('--related-tests', type=int, default=env_int('TESTGEN_RELATED_TESTS', 1),
+                        help="Number of related test files included in each prompt (env: TESTGEN_RELATED_TESTS)")
+    return parser.parse_args(argv)
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously at a per-minute rate."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount: float = 1.0):
+        """Block until the requested amount is available, then consume it."""
+        if self.rate <= 0:
+            return
+        # A single request larger than the bucket would otherwise wait forever
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RateLimiter:
+    """Limits API usage by both requests per minute and tokens per minute."""
+
+    def __init__(self, requests_per_minute: int = 0, tokens_per_minute: int = 0):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    def acquire(self, tokens: int):
+        """Wait until one request costing the given number of tokens may be sent."""
+        self.requests.acquire(1)
+        self.tokens.acquire(tokens)
+
+
+class ApiClient:
+    """Shared HTTP client with keep-alive connection pooling and retries with backoff."""
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, api_key: str, pool_size: int = 10, max_retries: int = 3,
+                 connect_timeout: float = 10.0, read_timeout: float = 60.0,
+                 backoff_base: float = 1.0, backoff_max: float = 30.0):
+        self.max_retries = max(0, max_retries)
+        self.timeout = (connect_timeout, read_timeout)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        # pool_block keeps the number of open connections at pool_size even
+        # when more threads than that are sending requests.
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(1, pool_size), pool_block=True)
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self.session.headers.update({
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {api_key}'
+        })
+
+        self.lock = threading.Lock()
+        self.retries = 0
+
+    def post(self, url: str, payload: dict, stream: bool = False,
+             cancel: Optional[threading.Event] = None) -> requests.Response:
+        """POST a JSON payload, retrying transient failures. Raises RequestException on failure.
+
+        With stream=True the body is left unread; only failures before the
+        response headers arrive are retried. Waits requested with Retry-After
+        are capped at backoff_max. Setting cancel stops any further
+        attempts and raises RequestCancelled.
+        """
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            if cancel is not None and cancel.is_set():
+                raise RequestCancelled("request cancelled")
+            try:
+                response = self.session.post(url, json=payload, timeout=self.timeout, stream=stream)
+            except (ConnectionError, Timeout) as e:
+                if last_attempt:
+                    raise
+                delay = self.backoff_delay(attempt)
+                reason = str(e)
+            else:
+                if response.status_code not in self.RETRY_STATUSES or last_attempt:
+                    response.raise_for_status()
+                    return response
+                retry_after = self.retry_after(response)
+                # A Retry-After of an hour would hold this worker and its pool slot that long
+                delay = min(retry_after, self.backoff_max) if retry_after is not None else self.backoff_delay(attempt)
+                reason = f"HTTP {response.status_code}"
+                response.close()
+
+            with self.lock:
+                self.retries += 1
+            logging.warning(f"API request failed ({reason}), retrying in {delay:.1f}s "
+                            f"(attempt {attempt + 1}/{self.max_retries})")
+            if cancel is not None:
+                cancel.wait(delay)
+            else:
+                time.sleep(delay)
+
+    def backoff_delay(self, attempt: int) -> float:
+        """Exponential backoff with full jitter."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    @staticmethod
+    def retry_after(response: requests.Response) -> Optional[float]:
+        """Seconds to wait according to the Retry-After header, if the server sent one."""
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def stats(self) -> Dict[str, int]:
+        """Request, retry and connection counters for the lifetime of the client."""
+        requests_sent = 0
+        connections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                requests_sent += pool.num_requests
+                connections += pool.num_connections
+        return {
+            'requests': requests_sent,
+            'retries': self.retries,
+            'new_connections': connections,
+            'reused_connections': max(0, requests_sent - connections)
+        }
+
+    def close(self):
+        """Close all pooled connections."""
+        self.session.close()
+
+
+class SourceCache:
+    """Contents of source files read during one run, so files shared between prompts are read once.
+
+    Entries are keyed by path and checked against the file's mtime and size
+    on every read, so a file changed mid-run is read again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries: Dict[str, Tuple[int, int, str, int]] = {}
+
+    def read(self, file_name: str) -> Tuple[str, int, bool]:
+        """Return a file's content, its size in bytes and whether it came from the cache."""
+        path = os.path.abspath(file_name)
+        stat = os.stat(path)
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+            return entry[2], entry[3], True
+        with open(path, 'r') as f:
+            content = f.read()
+        size = len(content.encode('utf-8'))
+        with self.lock:
+            self.entries[path] = (stat.st_mtime_ns, stat.st_size, content, size)
+        return content, size, False
+
+
+class RequestCancelled(RequestException):
+    """Raised when a request is cancelled because a hedged duplicate answered first."""
+
+
+class LatencyHistogram:
+    """Per-model request latency histograms with exponentially spaced buckets, kept across runs.
+
+    Counts are halved once a model has DECAY_AFTER samples, so the
+    estimates follow changes in API latency.
+    """
+
+    BUCKETS = tuple(0.05 * 2 ** (i / 2) for i in range(28))  # 50 ms to about 10 minutes
+    MIN_SAMPLES = 20
+    DECAY_AFTER = 1000
+
+    def __init__(self, path: Optional[Path] = None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.counts: Dict[str, List[int]] = {}
+        self.sums: Dict[str, float] = {}
+        self.load()
+
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+            for model, entry in saved.items():
+                if len(entry['counts']) == len(self.BUCKETS):
+                    self.counts[model] = [int(c) for c in entry['counts']]
+                    self.sums[model] = float(entry['sum'])
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            pass
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            encoded = json.dumps({model: {'counts': counts, 'sum': round(self.sums[model], 6)}
+                                  for model, counts in self.counts.items()})
+        try:
+            atomic_write_text(self.path, encoded)
+        except OSError as e:
+            logging.warning(f"Could not save latency histograms to {self.path}: {e}")
+
+    def record(self, model: str, seconds: float):
+        index = next((i for i, bound in enumerate(self.BUCKETS) if seconds <= bound), len(self.BUCKETS) - 1)
+        with self.lock:
+            counts = self.counts.setdefault(model, [0] * len(self.BUCKETS))
+            counts[index] += 1
+            self.sums[model] = self.sums.get(model, 0.0) + seconds
+            if sum(counts) >= self.DECAY_AFTER:
+                self.counts[model] = [c // 2 for c in counts]
+                self.sums[model] /= 2
+
+    def quantile(self, model: str, q: float) -> Optional[float]:
+        """Estimated latency quantile for a model, or None with fewer than MIN_SAMPLES samples."""
+        with self.lock:
+            counts = list(self.counts.get(model, ()))
+        total = sum(counts)
+        if total < self.MIN_SAMPLES:
+            return None
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(counts):
+            if count and seen + count >= rank:
+                # Interpolate linearly inside the bucket
+                lower = self.BUCKETS[i - 1] if i else 0.0
+                return lower + (self.BUCKETS[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.BUCKETS[-1]
+
+    def deadline(self, model: str, percentile: float, default: float) -> float:
+        """Seconds after which a request to the model is hedged."""
+        estimate = self.quantile(model, percentile / 100)
+        return default if estimate is None else estimate
+
+    def summary(self) -> Dict[str, dict]:
+        with self.lock:
+            models = {model: (sum(counts), self.sums[model]) for model, counts in self.counts.items()}
+        summary = {}
+        for model, (count, total) in models.items():
+            summary[model] = {'count': count, 'mean_seconds': round(total / count, 4) if count else 0.0}
+            for p in (50, 90, 99):
+                estimate = self.quantile(model, p / 100)
+                summary[model][f'p{p}_seconds'] = round(estimate, 4) if estimate is not None else None
+        return summary
+
+
+class ResponseCache:
+    """Content-addressed on-disk cache of API completions with least-recently-used eviction.
+
+    The size of the cache is tracked as a running estimate; the directory is
+    only scanned when the estimate crosses max_bytes, and every
+    RESCAN_WRITES writes to pick up entries written by other processes.
+    """
+
+    RESCAN_WRITES = 256
+    # Once over max_bytes, evict down to this share of it so the next writes do not scan again
+    LOW_WATER = 0.9
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.size: Optional[int] = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(payload: dict) -> str:
+        """Hash of everything in a request that determines the completion."""
+        keyed = {name: payload.get(name) for name in ('model', 'max_tokens', 'temperature', 'messages')}
+        encoded = json.dumps(keyed, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json"
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached completion for a key, or None on a miss."""
+        path = self.path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                content = json.load(f)['content']
+            # Touch the entry so eviction treats it as recently used
+            os.utime(path)
+        except (OSError, ValueError, KeyError, TypeError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return content
+
+    def put(self, key: str, content: str):
+        """Store a completion. The write is atomic, so concurrent readers never see partial entries."""
+        path = self.path(key)
+        text = json.dumps({'content': content, 'created': time.time()})
+        try:
+            atomic_write_text(path, text)
+        except OSError as e:
+            logging.warning(f"Could not write cache entry {path}: {e}")
+            return
+        with self.lock:
+            self.writes += 1
+            if self.size is not None:
+                self.size += len(text.encode('utf-8'))
+            scan = self.size is None or self.size > self.max_bytes or self.writes % self.RESCAN_WRITES == 0
+        if scan:
+            self.evict()
+
+    def delete(self, key: str):
+        """Remove an entry, e.g. a completion whose tests turned out not to work."""
+        try:
+            self.path(key).unlink()
+        except OSError:
+            return
+        with self.lock:
+            self.size = None
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits in max_bytes, with LOW_WATER headroom."""
+        with self.lock:
+            entries = []
+            total = 0
+            for path in self.directory.glob('*/*.json'):
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+            self.size = total
+            if total <= self.max_bytes:
+                return
+            target = self.max_bytes * self.LOW_WATER
+            for _, size, path in sorted(entries):
+                try:
+                    path.unlink()
+                except OSError:
+                    # Another process evicted it first
+                    continue
+                total -= size
+                self.size = total
+                self.evictions += 1
+                if total <= target:
+                    break
+
+
+# Coverage tool per language: how to check for it, how to install it, and what identifies the
+# toolchain it runs on (the executable, the lockfiles that pin its dependencies and where the
+# tool itself is installed: an importable module or a file relative to the project)
+TOOLCHAINS = {
+    'Python': {'tool': 'coverage', 'check': [sys.executable, '-m', 'coverage', '--version'],
+               'install': [sys.executable, '-m', 'pip', 'install', 'coverage'], 'executable': sys.executable,
+               'lockfiles': ('requirements.txt', 'Pipfile.lock', 'poetry.lock', 'uv.lock'), 'module': 'coverage'},
+    'JavaScript': {'tool': 'jest', 'check': ['npm', 'list', 'jest'], 'install': ['npm', 'install', 'jest'],
+                   'executable': 'npm', 'lockfiles': ('package.json', 'package-lock.json', 'yarn.lock', 'pnpm-lock.yaml'),
+                   'installed': 'node_modules/jest/package.json'},
+    'Ruby': {'tool': 'simplecov', 'check': ['gem', 'list', '-i', 'simplecov'],
+             'install': ['gem', 'install', 'simplecov'], 'executable': 'gem', 'lockfiles': ('Gemfile.lock',)},
+}
+TOOLCHAIN_NOTES = {
+    'Java': "Ensure Jacoco is configured in your Maven/Gradle build.",
+    'Go': "Go coverage is handled by the 'go test' command.",
+}
+
+
+class ToolchainRegistry:
+    """Which coverage tools are usable, probed once per language and remembered on disk.
+
+    Languages are probed in parallel on a background pool, so probing
+    overlaps with generation. A successful probe is reused by later runs
+    for as long as the executable, the project's lockfiles and the installed
+    tool are unchanged, so a restored cache on a fresh machine without the
+    tool probes again; a missing tool is installed if possible and
+    otherwise probed again next run.
+    """
+
+    def __init__(self, cache_file: Optional[Path], root: Optional[Path] = None):
+        self.cache_file = cache_file
+        self.root = Path(root or Path.cwd())
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=len(TOOLCHAINS), thread_name_prefix='toolchain')
+        self.futures: Dict[Tuple[str, str], Future] = {}
+        self.keys: Dict[str, Tuple[tuple, str]] = {}
+        self.probes = 0
+        self.cache_hits = 0
+        self.known = self.load()
+
+    def load(self) -> Dict[str, dict]:
+        if not self.cache_file:
+            return {}
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                known = json.load(f)
+            return known if isinstance(known, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        if not self.cache_file:
+            return
+        with self.lock:
+            encoded = json.dumps(self.known, indent=2, sort_keys=True)
+        try:
+            atomic_write_text(self.cache_file, encoded)
+        except OSError as e:
+            logging.warning(f"Could not save toolchain registry {self.cache_file}: {e}")
+
+    def key(self, language: str) -> str:
+        """Hash of the resolved executable and lockfile contents for a language's toolchain.
+
+        The hash is remembered until PATH, the installed tool or a lockfile's
+        mtime or size changes, so repeated calls only stat those files.
+        """
+        spec = TOOLCHAINS.get(language)
+        if not spec:
+            return ''
+        signature = [os.environ.get('PATH', ''), self.installed(spec)]
+        for name in spec['lockfiles']:
+            try:
+                info = (self.root / name).stat()
+                signature.append((name, info.st_mtime_ns, info.st_size))
+            except OSError:
+                signature.append((name, None))
+        signature = tuple(signature)
+        with self.lock:
+            cached = self.keys.get(language)
+        if cached and cached[0] == signature:
+            return cached[1]
+
+        executable = shutil.which(spec['executable']) or spec['executable']
+        digest = hashlib.sha256(os.path.realpath(executable).encode('utf-8'))
+        digest.update(repr(signature[1]).encode('utf-8'))
+        for name in spec['lockfiles']:
+            try:
+                content = (self.root / name).read_bytes()
+            except OSError:
+                continue
+            digest.update(f"\0{name}\0".encode('utf-8') + content)
+        key = digest.hexdigest()
+        with self.lock:
+            self.keys[language] = (signature, key)
+        return key
+
+    def installed(self, spec: dict) -> tuple:
+        """Path, mtime and size of the installed tool, or (None,) if it is not installed."""
+        path = None
+        if spec.get('module'):
+            found = importlib.util.find_spec(spec['module'])
+            path = found.origin if found else None
+        elif spec.get('installed'):
+            path = str(self.root / spec['installed'])
+        try:
+            info = os.stat(path)
+        except (OSError, TypeError):
+            return (None,)
+        return (path, info.st_mtime_ns, info.st_size)
+
+    def probe(self, languages: Iterable[str]):
+        """Start probing the given languages in the background."""
+        for language in set(languages):
+            self.future(language)
+
+    def future(self, language: str) -> Future:
+        # Keyed by toolchain too, so a long-lived daemon re-probes after a lockfile changes
+        key = (language, self.key(language))
+        with self.lock:
+            if key not in self.futures:
+                self.futures[key] = self.executor.submit(self.check, language, key[1])
+            return self.futures[key]
+
+    def available(self, language: str) -> bool:
+        """Whether the coverage tool for a language can be used, waiting for its probe if needed."""
+        return self.future(language).result()
+
+    def check(self, language: str, key: str) -> bool:
+        spec = TOOLCHAINS.get(language)
+        if not spec:
+            if language in TOOLCHAIN_NOTES:
+                logging.info(TOOLCHAIN_NOTES[language])
+                return True
+            logging.warning(f"Coverage tool check is not configured for {language}. Please add it manually.")
+            return False
+
+        with self.lock:
+            entry = self.known.get(language)
+            if entry and entry.get('key') == key:
+                self.cache_hits += 1
+                logging.info(f"Coverage tool for {language} ({spec['tool']}) is available, probed earlier")
+                return True
+            self.probes += 1
+
+        try:
+            output = subprocess.run(spec['check'], capture_output=True, text=True, check=True).stdout
+            logging.info(f"Coverage tool for {language} ({spec['tool']}) is already installed.")
+        except (OSError, subprocess.CalledProcessError):
+            logging.error(f"Coverage tool for {language} is not installed. Installing...")
+            try:
+                output = subprocess.run(spec['install'], capture_output=True, text=True, check=True).stdout
+                logging.info(f"Coverage tool for {language} ({spec['tool']}) has been installed.")
+                # Remember the probe under the key of the toolchain with the tool installed
+                importlib.invalidate_caches()
+                key = self.key(language)
+            except (OSError, subprocess.CalledProcessError):
+                logging.error(f"Failed to install the coverage tool for {language}. Please install it manually.")
+                with self.lock:
+                    self.known.pop(language, None)
+                self.save()
+                return False
+
+        with self.lock:
+            self.known[language] = {'key': key, 'tool': spec['tool'], 'checked': time.time(),
+                                    'detail': (output.strip().splitlines() or [''])[0][:200]}
+        self.save()
+        return True
+
+    def stats(self) -> dict:
+        with self.lock:
+            ready = {language: future.result() for (language, _), future in self.futures.items() if future.done()}
+            return {'probes': self.probes, 'cache_hits': self.cache_hits, 'available': ready}
+
+
+# Prepended to every generated Python test file so it can import the project's modules
+PYTHON_TEST_HEADER = (
+    "import sys\n"
+    "import os\n"
+    "sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))\n\n"
+)
+# Tail of the pytest output sent back with a repair request
+REPAIR_OUTPUT_CHARS = 6000
+
+SOURCE_EXTENSIONS = ('.py', '.js', '.ts')
+IGNORED_DIRS = {'.git', '.hg', '.svn', 'node_modules', '__pycache__', '.venv', 'venv', 'env',
+                '.tox', '.nox', '.mypy_cache', '.pytest_cache', '.ruff_cache', 'build', 'dist'}
+
+TEST_FILE_PATTERN = re.compile(
+    r'(^|/)(tests?\.py|test_[^/]*\.(py|js|ts)|[^/]*_test\.py|[^/]*\.(test|spec)\.(js|ts))$'
+)
+JS_COMMENT_PATTERN = re.compile(r'/\*.*?\*/|^\s*//.*?$', re.DOTALL | re.MULTILINE)
+JS_IMPORT_PATTERN = re.compile(
+    r"""(?:\bimport\s+(?:[\w*{}\s,$]+?\s+from\s+)?|\bexport\s+[\w*{}\s,$]+?\s+from\s+"""
+    r"""|\brequire\s*\(\s*|\bimport\s*\(\s*)['"]([^'"\n]+)['"]"""
+)
+
+
+class ProjectIndex:
+    """Import graph of the project's Python and JavaScript/TypeScript sources.
+
+    Imports are parsed once per file with ast (Python) or a light tokenizer
+    (JavaScript/TypeScript) and persisted to disk. A refresh only re-parses
+    files whose mtime or size changed since the index was saved. The same
+    walk yields an inverted index from each source file to the test files
+    that import it.
+    """
+
+    VERSION = 1
+
+    def __init__(self, root: Path, index_file: Optional[Path] = None, ignored_dirs: Optional[set] = None):
+        self.root = Path(root).resolve()
+        self.index_file = index_file
+        self.ignored_dirs = IGNORED_DIRS | (ignored_dirs or set())
+        self.files: Dict[str, dict] = {}
+        self.modules: Dict[str, str] = {}
+        self.tests_by_file: Dict[str, List[str]] = {}
+        self.parsed = 0
+        self.built = False
+
+    def relative(self, file_name: str) -> str:
+        """Index key (root-relative POSIX path) for a file name."""
+        path = Path(file_name)
+        if path.is_absolute():
+            try:
+                path = path.resolve().relative_to(self.root)
+            except ValueError:
+                return path.as_posix()
+        return Path(os.path.normpath(str(path))).as_posix()
+
+    def load(self):
+        """Load a previously saved index, ignoring it if it is missing or stale."""
+        if not self.index_file:
+            return
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') == self.VERSION and data.get('root') == str(self.root):
+            self.files = data.get('files', {})
+
+    def save(self):
+        if not self.index_file:
+            return
+        data = {'version': self.VERSION, 'root': str(self.root), 'files': self.files}
+        try:
+            atomic_write_text(self.index_file, json.dumps(data))
+        except OSError as e:
+            logging.warning(f"Could not save project index to {self.index_file}: {e}")
+
+    def walk(self):
+        """Yield (relative path, stat) for every source file under the root."""
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = sorted(d for d in dirnames if d not in self.ignored_dirs)
+            for filename in sorted(filenames):
+                if not filename.endswith(SOURCE_EXTENSIONS):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield Path(os.path.relpath(path, self.root)).as_posix(), stat
+
+    def refresh(self) -> bool:
+        """Bring the index up to date with the tree, re-parsing only changed files.
+
+        Returns whether anything changed since the last refresh.
+        """
+        if not self.files:
+            self.load()
+        files = {}
+        self.parsed = 0
+        for rel_path, stat in self.walk():
+            entry = self.files.get(rel_path)
+            if not entry or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+                entry = {'mtime': stat.st_mtime, 'size': stat.st_size,
+                         'imports': self.parse_imports(self.root / rel_path)}
+                self.parsed += 1
+            files[rel_path] = entry
+        changed = self.parsed > 0 or len(files) != len(self.files)
+        if not changed and self.built:
+            # Nothing to rebuild; this is the common case for a daemon polling an idle tree
+            return False
+        # Build the lookup tables aside and swap them in, so concurrent readers never see a partial index
+        modules = {}
+        for rel_path in files:
+            module = self.module_name(rel_path)
+            if module:
+                modules.setdefault(module, rel_path)
+                if module.startswith('src.'):
+                    modules.setdefault(module[4:], rel_path)
+        self.files, self.modules = files, modules
+        tests_by_file = {}
+        for rel_path in files:
+            if self.is_test_file(rel_path):
+                for target in self.imports_of(rel_path):
+                    tests_by_file.setdefault(target, []).append(rel_path)
+        self.tests_by_file = tests_by_file
+        self.built = True
+        if changed:
+            self.save()
+        logging.info(f"Project index: {len(files)} files, {self.parsed} parsed, "
+                     f"{sum(1 for f in files if self.is_test_file(f))} test files")
+        return changed
+
+    @staticmethod
+    def is_test_file(rel_path: str) -> bool:
+        return bool(TEST_FILE_PATTERN.search(rel_path))
+
+    @staticmethod
+    def module_name(rel_path: str) -> Optional[str]:
+        """Dotted Python module name for a root-relative .py path."""
+        if not rel_path.endswith('.py'):
+            return None
+        parts = rel_path[:-3].split('/')
+        if parts[-1] == '__init__':
+            parts = parts[:-1]
+        return '.'.join(parts) or None
+
+    def parse_imports(self, path: Path) -> List[str]:
+        """Raw import specifiers of a file, in source order."""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                source = f.read()
+        except (OSError, UnicodeDecodeError) as e:
+            logging.warning(f"Could not read {path} for indexing: {e}")
+            return []
+        if path.suffix == '.py':
+            return self.parse_python_imports(source, str(path))
+        return self.parse_js_imports(source)
+
+    @staticmethod
+    def parse_python_imports(source: str, file_name: str = '<unknown>') -> List[str]:
+        try:
+            tree = ast.parse(source, filename=file_name)
+        except (SyntaxError, ValueError) as e:
+            logging.warning(f"Could not parse {file_name} for indexing: {e}")
+            return []
+        imports = []
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                imports.extend(alias.name for alias in node.names)
+            elif isinstance(node, ast.ImportFrom):
+                module = '.' * node.level + (node.module or '')
+                imports.append(module)
+                # `from pkg import mod` may name a submodule rather than an attribute
+                separator = '' if module.endswith('.') else '.'
+                imports.extend(f"{module}{separator}{alias.name}" for alias in node.names if alias.name != '*')
+        return imports
+
+    @staticmethod
+    def parse_js_imports(source: str) -> List[str]:
+        source = JS_COMMENT_PATTERN.sub('', source)
+        return JS_IMPORT_PATTERN.findall(source)
+
+    def resolve(self, importer: str, spec: str) -> Optional[str]:
+        """Map an import specifier found in importer to a project file, if it is one."""
+        importer_dir = os.path.dirname(importer)
+        if importer.endswith('.py'):
+            if spec.startswith('.'):
+                level = len(spec) - len(spec.lstrip('.'))
+                base = importer_dir.split('/') if importer_dir else []
+                if level - 1 > len(base):
+                    return None
+                base = base[:len(base) - (level - 1)]
+                name = spec[level:]
+                candidates = ['/'.join(base + name.split('.')) if name else '/'.join(base)]
+            else:
+                module = self.modules.get(spec)
+                if module:
+                    return module
+                # Script-style import of a sibling module
+                candidates = [os.path.join(importer_dir, *spec.split('.'))]
+            for candidate in candidates:
+                candidate = candidate.strip('/')
+                for option in (f"{candidate}.py", f"{candidate}/__init__.py"):
+                    if option in self.files:
+                        return option
+            return None
+
+        if not spec.startswith('.'):
+            # Bare specifiers refer to packages, not project files
+            return None
+        candidate = Path(os.path.normpath(os.path.join(importer_dir, spec))).as_posix()
+        for option in (candidate, f"{candidate}.js", f"{candidate}.ts",
+                       f"{candidate}/index.js", f"{candidate}/index.ts"):
+            if option in self.files:
+                return option
+        return None
+
+    def imports_of(self, file_name: str) -> List[str]:
+        """Project files imported by a file, in source order without duplicates."""
+        rel_path = self.relative(file_name)
+        entry = self.files.get(rel_path)
+        if entry is None:
+            imports = self.parse_imports(self.root / rel_path)
+        else:
+            imports = entry['imports']
+        resolved = []
+        for spec in imports:
+            target = self.resolve(rel_path, spec)
+            if target and target != rel_path and target not in resolved:
+                resolved.append(target)
+        return resolved
+
+    def related_tests(self, file_name: str, limit: int = 1) -> List[str]:
+        """Test files importing a file, best match first.
+
+        Tests named after the file rank first, then tests that import fewer
+        project files, since those are more focused on the file under test.
+        """
+        rel_path = self.relative(file_name)
+        stem = Path(rel_path).stem
+
+        def rank(test_file: str):
+            name = Path(test_file).name
+            named_after = (name.split('.')[0] in (f"test_{stem}", f"{stem}_test")
+                           or name.startswith((f"{stem}.test.", f"{stem}.spec.")))
+            return (not named_after, len(self.imports_of(test_file)), test_file)
+
+        tests = sorted(self.tests_by_file.get(rel_path, []), key=rank)
+        return tests[:limit] if limit > 0 else tests
+
+
+class StreamAborted(Exception):
+    """Raised when a streamed completion is abandoned before it finishes."""
+
+
+REFUSAL_PATTERN = re.compile(
+    r"^\s*(I'm sorry|I am sorry|Sorry\b|I cannot|I can't|I'm unable|I am unable|As an AI|Unfortunately\b)",
+    re.IGNORECASE
+)
+
+
+def iter_sse_content(response: requests.Response, on_usage: Optional[Callable[[dict], None]] = None) -> Iterator[str]:
+    """Yield the content deltas of a server-sent events chat completion stream.
+
+    on_usage is called with the usage object if the stream reports one.
+    """
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith('data:'):
+            continue
+        data = line[5:].strip()
+        if data == '[DONE]':
+            return
+        try:
+            event = json.loads(data)
+        except ValueError:
+            logging.warning(f"Ignoring malformed stream event: {data[:80]}")
+            continue
+        if event.get('usage') and on_usage:
+            on_usage(event['usage'])
+        for choice in event.get('choices') or []:
+            content = (choice.get('delta') or {}).get('content')
+            if content:
+                yield content
+
+
+class StreamNormalizer:
+    """Incremental equivalent of TestGenerator.normalize_completion.
+
+    Quotes are replaced chunk by chunk. The start of the stream is buffered
+    until it is clear whether it opens a code fence, and trailing whitespace
+    and backticks are held back until more text arrives or the stream ends.
+    """
+
+    QUOTES = str.maketrans({'“': '"', '”': '"', '‘': "'", '’': "'"})
+    FENCED_TAIL = re.compile(r'\s*`{0,3}$')
+    PLAIN_TAIL = re.compile(r'\s*$')
+
+    def __init__(self):
+        self.buffer = ''
+        self.fenced: Optional[bool] = None
+        self.in_fence_line = False
+        self.started = False
+        self.pending = ''
+
+    def feed(self, chunk: str) -> str:
+        """Consume a chunk and return the text that is now safe to write."""
+        chunk = chunk.translate(self.QUOTES)
+        if self.fenced is None or self.in_fence_line:
+            self.buffer += chunk
+            if self.fenced is None:
+                if len(self.buffer) < 3:
+                    return ''
+                self.fenced = self.buffer.startswith('```')
+                self.in_fence_line = self.fenced
+            if self.in_fence_line:
+                # Drop the opening fence line once it is complete
+                newline = self.buffer.find('\n', 3)
+                if newline == -1:
+                    return ''
+                self.buffer = self.buffer[newline + 1:]
+                self.in_fence_line = False
+            chunk, self.buffer = self.buffer, ''
+        return self.emit(chunk)
+
+    def emit(self, chunk: str) -> str:
+        text = self.pending + chunk
+        if not self.started:
+            text = text.lstrip()
+            if not text:
+                self.pending = ''
+                return ''
+            self.started = True
+        tail = (self.FENCED_TAIL if self.fenced else self.PLAIN_TAIL).search(text)
+        self.pending = text[tail.start():]
+        return text[:tail.start()]
+
+    def finish(self) -> str:
+        """Return whatever was held back, with the closing fence and whitespace removed."""
+        if self.in_fence_line:
+            # The opening fence was never followed by a newline
+            self.buffer = self.buffer[3:]
+        self.fenced = bool(self.fenced)
+        self.in_fence_line = False
+        text = self.emit(self.buffer)
+        self.buffer = ''
+        tail = self.pending
+        if self.fenced and tail.endswith('```'):
+            tail = tail[:-3]
+        self.pending = ''
+        return text + tail.rstrip()
+
+
+class Metrics:
+    """Thread-safe wall time per pipeline stage and run-wide counters."""
+
+    def __init__(self, profile_file: Optional[str] = None):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.counters: Dict[str, float] = defaultdict(float)
+        self.profile_file = profile_file
+        self.profiler = cProfile.Profile() if profile_file else None
+        self.profile_lock = threading.RLock()
+        self.profile_depth = 0
+
+    @contextmanager
+    def stage(self, name: str, profile: bool = False):
+        """Time a block of work as one call of the named stage."""
+        if profile and self.profiler:
+            with self.profile_lock, self.profiled():
+                with self.stage(name):
+                    yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    @contextmanager
+    def profiled(self):
+        # Only the outermost profiled stage switches the profiler on
+        self.profile_depth += 1
+        if self.profile_depth == 1:
+            self.profiler.enable()
+        try:
+            yield
+        finally:
+            self.profile_depth -= 1
+            if self.profile_depth == 0:
+                self.profiler.disable()
+
+    def record(self, name: str, seconds: float):
+        with self.lock:
+            stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            stage['calls'] += 1
+            stage['seconds'] += seconds
+            stage['max_seconds'] = max(stage['max_seconds'], seconds)
+
+    def add(self, name: str, value: float = 1):
+        with self.lock:
+            self.counters[name] += value
+
+    def add_usage(self, usage: Optional[dict]):
+        """Count the tokens reported in an API response's usage object."""
+        if not usage:
+            return
+        self.add('prompt_tokens', usage.get('prompt_tokens') or 0)
+        self.add('completion_tokens', usage.get('completion_tokens') or 0)
+        # Prompt tokens the provider served from its prefix cache
+        self.add('cached_prompt_tokens', (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0)
+
+    def report(self, extra: Optional[dict] = None) -> dict:
+        with self.lock:
+            report = {
+                'started': self.started,
+                'duration_seconds': round(time.time() - self.started, 3),
+                'stages': {name: {'calls': int(s['calls']), 'seconds': round(s['seconds'], 6),
+                                  'max_seconds': round(s['max_seconds'], 6)}
+                           for name, s in sorted(self.stages.items())},
+                'counters': {name: int(value) if float(value).is_integer() else value
+                             for name, value in sorted(self.counters.items())}
+            }
+        report.update(extra or {})
+        return report
+
+    @staticmethod
+    def format_prometheus(report: dict) -> str:
+        """Render a run report in the Prometheus text exposition format."""
+        lines = [
+            '# HELP testgen_stage_seconds_total Wall time spent in each pipeline stage.',
+            '# TYPE testgen_stage_seconds_total counter'
+        ]
+        lines += [f'testgen_stage_seconds_total{{stage="{name}"}} {s["seconds"]}' for name, s in report['stages'].items()]
+        lines += ['# HELP testgen_stage_calls_total Calls of each pipeline stage.',
+                  '# TYPE testgen_stage_calls_total counter']
+        lines += [f'testgen_stage_calls_total{{stage="{name}"}} {s["calls"]}' for name, s in report['stages'].items()]
+        for section in ('counters', 'api', 'cache'):
+            for name, value in (report.get(section) or {}).items():
+                metric = f"testgen_{name}_total" if section == 'counters' else f"testgen_{section}_{name}_total"
+                lines += [f'# TYPE {metric} counter', f'{metric} {value}']
+        toolchains = report.get('toolchains') or {}
+        for name in ('probes', 'cache_hits'):
+            if name in toolchains:
+                lines += [f'# TYPE testgen_toolchain_{name}_total counter', f"testgen_toolchain_{name}_total {toolchains[name]}"]
+        quantiles = [f'testgen_api_latency_seconds{{model="{model}",quantile="0.{p}"}} {summary[f"p{p}_seconds"]}'
+                     for model, summary in sorted((report.get('latency') or {}).items())
+                     for p in (50, 90, 99) if summary[f"p{p}_seconds"] is not None]
+        if quantiles:
+            lines += ['# HELP testgen_api_latency_seconds Estimated API latency quantiles per model.',
+                      '# TYPE testgen_api_latency_seconds gauge'] + quantiles
+        lines += ['# HELP testgen_files Files by outcome in the last run.', '# TYPE testgen_files gauge']
+        lines += [f'testgen_files{{status="{status}"}} {count}' for status, count in (report.get('files') or {}).items()]
+        lines += ['# TYPE testgen_run_duration_seconds gauge', f"testgen_run_duration_seconds {report['duration_seconds']}"]
+        return '\n'.join(lines) + '\n'
+
+    def save_profile(self):
+        if self.profiler and self.profile_file:
+            self.profiler.dump_stats(self.profile_file)
+            logging.info(f"Profile of local stages saved to {self.profile_file}")
+
+
+def instrumented(stage: str, local: bool = False):
+    """Record each call of a TestGenerator method as a stage in self.metrics.
+
+    local marks stages that do no network or subprocess work; only those
+    are profiled when --profile is given.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.stage(stage, profile=local):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Options a daemon client may set per request; everything else is fixed when the daemon starts
+REQUEST_OPTIONS = ('refresh', 'stream', 'no_coverage', 'incremental', 'base_ref', 'related_tests',
+                   'prompt_tokens', 'chunk_tokens', 'validate', 'repair_rounds', 'metrics_json', 'prometheus_file')
+
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+    """Handles one JSON-lines request from a client of the test generation daemon."""
+
+    def handle(self):
+        write_lock = threading.Lock()
+
+        def send(event: dict):
+            with write_lock:
+                self.wfile.write((json.dumps(event) + '\n').encode('utf-8'))
+                self.wfile.flush()
+
+        try:
+            request = json.loads(self.rfile.readline() or b'{}')
+        except ValueError:
+            send({'event': 'error', 'message': 'malformed request'})
+            return
+
+        generator = self.server.generator
+        if request.get('command') == 'stop':
+            send({'event': 'done', 'message': 'daemon stopping'})
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return
+
+        # Paths are sent relative to the client's directory
+        client_dir = request.get('cwd') or os.getcwd()
+        files = [os.path.relpath(os.path.join(client_dir, f), os.getcwd()) for f in request.get('files', [])]
+        overrides = {k: v for k, v in (request.get('options') or {}).items() if k in REQUEST_OPTIONS}
+
+        def on_result(result: FileResult):
+            send({'event': 'result', 'file': result.file_name, 'language': result.language,
+                  'test_file': str(result.test_file) if result.test_file else None,
+                  'error': result.error, 'skipped': result.skipped, 'seconds': round(result.seconds, 3),
+                  'validation': result.validation})
+
+        try:
+            worker = generator.for_request(overrides)
+            results = worker.run(files, on_result=on_result)
+            send({'event': 'done', 'report': worker.run_report(results)})
+        except Exception as e:
+            logging.error(f"Daemon request failed: {e}")
+            send({'event': 'error', 'message': str(e)})
+
+
+class TestGeneratorDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server sharing one warm TestGenerator between requests."""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, generator: 'TestGenerator'):
+        self.generator = generator
+        super().__init__(socket_path, DaemonRequestHandler)
+
+
+def run_client(options: argparse.Namespace) -> int:
+    """Submit changed files to a running daemon and print results as they stream back."""
+    if options.stop:
+        request = {'command': 'stop'}
+    else:
+        files = [f.strip() for arg in options.changed_files for f in arg.split() if f.strip()]
+        overrides = {name: getattr(options, name) for name in REQUEST_OPTIONS}
+        for name in ('metrics_json', 'prometheus_file'):
+            if overrides[name]:
+                overrides[name] = os.path.abspath(overrides[name])
+        request = {'files': files, 'cwd': os.getcwd(), 'options': overrides}
+
+    # A relative socket path is found from any subdirectory of the project, like git finds .git
+    socket_path = options.socket
+    if not os.path.isabs(socket_path):
+        for directory in [Path.cwd(), *Path.cwd().parents]:
+            if (directory / socket_path).exists():
+                socket_path = str(directory / socket_path)
+                break
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(socket_path)
+            client.sendall((json.dumps(request) + '\n').encode('utf-8'))
+            with client.makefile('r', encoding='utf-8') as responses:
+                for line in responses:
+                    event = json.loads(line)
+                    if event['event'] == 'result':
+                        outcome = event['test_file'] or ('skipped' if event['skipped'] else f"failed ({event['error']})")
+                        logging.info(f"{event['file']}: {outcome} in {event['seconds']}s")
+                    elif event['event'] == 'error':
+                        logging.error(f"Daemon error: {event['message']}")
+                        return 1
+                    elif event['event'] == 'done':
+                        files = (event.get('report') or {}).get('files')
+                        logging.info(f"Daemon finished: {files or event.get('message')}")
+                        return 0
+    except (OSError, ValueError) as e:
+        logging.error(f"Could not talk to the daemon on {socket_path}: {e}")
+        return 1
+    logging.error("Daemon closed the connection before finishing")
+    return 1
+
+
+@dataclass
+class FileResult:
+    """Outcome of processing a single changed file."""
+    file_name: str
+    language: str = 'Unknown'
+    test_file: Optional[Path] = None
+    error: Optional[str] = None
+    skipped: bool = False
+    seconds: float = 0.0
+    validation: Optional[str] = None
+    repairs: int = 0
+    # Response cache entries of the completions the test file was generated from
+    cache_keys: List[str] = field(default_factory=list)
+
+
 class TestGenerator:
-    def __init__(self):
+    def __init__(self, options: Optional[argparse.Namespace] = None):
+        self.options = options or parse_args([])
         self.api_key = os.getenv('OPENAI_API_KEY')
         self.model = os.getenv('OPENAI_MODEL', 'o1-preview')
+        self.api_base = os.getenv('OPENAI_API_BASE', 'https://api.openai.com/v1').rstrip('/')
         
         try:
             self.max_tokens = int(os.getenv('OPENAI_MAX_TOKENS', '10000'))
@@ -27,11 +1725,39 @@ class TestGenerator:
         if not self.api_key:
             raise ValueError("OPENAI_API_KEY environment variable is not set")
 
+        self.workers = max(1, self.options.workers)
+        self.metrics = Metrics(self.options.profile)
+        # Chunk requests get their own pool so file workers waiting on them cannot starve it
+        self.chunk_executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='chunk')
+        # Each validation thread drives one pytest process, so this is the size of the test process pool
+        self.validation_executor = ThreadPoolExecutor(max_workers=self.options.validation_jobs or self.workers,
+                                                      thread_name_prefix='validate')
+        self._validations: List[Future] = []
+        self.rate_limiter = RateLimiter(self.options.requests_per_minute, self.options.tokens_per_minute)
+        self.client = ApiClient(
+            self.api_key,
+            # Hedged duplicates need connections of their own while the originals are still in flight
+            pool_size=self.options.pool_size or self.workers * (2 if self.options.hedge else 1),
+            max_retries=self.options.max_retries,
+            connect_timeout=self.options.connect_timeout,
+            read_timeout=self.options.read_timeout
+        )
+        self.sources = SourceCache()
+        self.latency = LatencyHistogram(Path(self.options.cache_dir) / 'latency.json')
+        self.hedge_executor = ThreadPoolExecutor(max_workers=2 * self.workers, thread_name_prefix='hedge')
+        self.cache = None
+        if not self.options.no_cache:
+            self.cache = ResponseCache(Path(self.options.cache_dir), self.options.cache_max_mb * 1024 * 1024)
+        self.toolchains = ToolchainRegistry(Path(self.options.cache_dir) / 'toolchains.json')
+        self._index_lock = threading.Lock()
+        self._project_index: Optional[ProjectIndex] = None
+        self.shard_info: Optional[dict] = None
+
     def get_changed_files(self) -> List[str]:
         """Retrieve list of changed files passed as command-line arguments."""
-        if len(sys.argv) <= 1:
-            return []
-        return [f.strip() for f in sys.argv[1].split() if f.strip()]
+        files = [f.strip() for arg in self.options.changed_files for f in arg.split() if f.strip()]
+        # Drop duplicates so two workers never write the same test file
+        return list(dict.fromkeys(files))
 
     def detect_language(self, file_name: str) -> str:
         """Detect programming language based on file extension."""
@@ -60,42 +1786,27 @@ class TestGenerator:
         }
         return frameworks.get(language, 'unknown')
     
+    @property
+    def project_index(self) -> ProjectIndex:
+        """Import index of the working tree, built once per run and shared by all workers."""
+        with self._index_lock:
+            if self._project_index is None:
+                cache_dir = Path(self.options.cache_dir)
+                index = ProjectIndex(Path.cwd(), cache_dir / 'import_index.json', ignored_dirs={cache_dir.name})
+                with self.metrics.stage('project_index', profile=True):
+                    index.refresh()
+                self.metrics.add('index_files_parsed', index.parsed)
+                self._project_index = index
+            return self._project_index
+
+    @instrumented('get_related_files', local=True)
     def get_related_files(self, language: str, file_name: str) -> List[str]:
         """Identify related files based on import statements or includes."""
         related_files = []
         
         try:
             if language in ["Python", "JavaScript", "TypeScript"]:
-                with open(file_name, 'r') as f:
-                    for line in f:
-                        if 'import ' in line or 'from ' in line or 'require(' in line:
-                            parts = line.split()
-                            for part in parts:
-                                # Handle relative imports
-                                if part.startswith('.') and not part.startswith('..'):
-                                    path = part.replace(".", "")
-                                    for ext in ('.py', '.js', '.ts'):
-                                        potential_file = f"{path}{ext}"
-                                        if Path(potential_file).exists():
-                                            related_files.append(potential_file)
-                                            break
-                                elif '.' in part:
-                                    path = part.replace(".", "/")
-                                    for ext in ('.py', '.js', '.ts'):
-                                        potential_file = f"{path}{ext}"
-                                        if Path(potential_file).exists():
-                                            related_files.append(potential_file)
-                                            break
-                                else:
-                                    if part.endswith(('.py', '.js', '.ts')) and Path(part).exists():
-                                        related_files.append(part)
-                                    elif part.isidentifier():
-                                        base_name = part.lower()
-                                        for ext in ('.py', '.js', '.ts'):
-                                            potential_file = f"{base_name}{ext}"
-                                            if Path(potential_file).exists():
-                                                related_files.append(potential_file)
-                                                break
+                related_files = self.project_index.imports_of(file_name)
             elif language == 'C++':
                 # Implement C++ related file detection logic here
                 pass  # Placeholder for C++ implementation
@@ -108,55 +1819,21 @@ class TestGenerator:
         
         return related_files
 
+    @instrumented('get_related_test_files', local=True)
     def get_related_test_files(self, language: str, file_name: str) -> List[str]:
         """Identify related test files based on import statements or includes."""
         related_test_files = []
         try:
-            if language == "Python":
-                directory = Path(os.path.dirname(os.path.abspath(__file__)))
-                test_files = list(directory.rglob("tests.py")) + \
-                             list(directory.rglob("test.py")) + \
-                             list(directory.rglob("test_*.py")) + \
-                             list(directory.rglob("*_test.py"))
-                for test_file in test_files:
-                    with open(test_file, 'r') as f:
-                        for line in f:
-                            if 'from ' in line:
-                                parts = line.split()
-                                for part in parts:
-                                    if part.startswith('.') and not part.startswith('..'):
-                                        path = part.replace(".", "")
-                                        for ext in ('.py', '.js', '.ts'):
-                                            potential_file = f"{path}{ext}"
-                                            if Path(potential_file).exists() and potential_file in file_name:
-                                                related_test_files.append(str(test_file))
-                                                break
-                                    elif '.' in part:
-                                        path = part.replace(".", "/")
-                                        for ext in ('.py', '.js', '.ts'):
-                                            potential_file = f"{path}{ext}"
-                                            if Path(potential_file).exists() and potential_file in file_name:
-                                                related_test_files.append(str(test_file))
-                                                break
-                                    else:
-                                        if part.endswith(('.py', '.js', '.ts')) and Path(part).exists() and (file_name in part):
-                                            related_test_files.append(str(test_file))
-                                        elif part.isidentifier():
-                                            base_name = part.lower()
-                                            for ext in ('.py', '.js', '.ts', '.js'):
-                                                potential_file = f"{base_name}{ext}"
-                                                if Path(potential_file).exists() and (file_name in potential_file):
-                                                    related_test_files.append(str(test_file))
-                                                    break
+            if language in ["Python", "JavaScript", "TypeScript"]:
+                related_test_files = self.project_index.related_tests(file_name, self.options.related_tests)
             # Implement related test file detection for other languages if needed
 
         except Exception as e:
             logging.error(f"Error identifying related test files in {file_name}: {e}")
         
-        # Limit to the first related test file to avoid excessive processing
-        limited_test_files = related_test_files[:1]
-        return limited_test_files
+        return related_test_files
 
+    @instrumented('generate_coverage_report')
     def generate_coverage_report(self, test_file: Path, language: str):
         """Generate a code coverage report and save it as a text file."""
         report_file = test_file.parent / f"{test_file.stem}_coverage_report.txt"
@@ -201,57 +1878,154 @@ class TestGenerator:
         except subprocess.CalledProcessError as e:
             logging.error(f"Error generating coverage report for {test_file}: {e}")
 
-    def ensure_coverage_installed(self, language: str):
+    def generate_coverage_reports(self, results: List[FileResult]):
+        """Measure coverage of all generated tests, batching each language into one run where possible.
+
+        Python tests run in a single pytest session under coverage (or
+        --coverage-jobs sessions in parallel mode, combined afterwards) and
+        JavaScript tests in a single jest run. Other languages still use
+        generate_coverage_report per test file.
+        """
+        # Later files win when several share a test file, as with saving
+        by_test_file = {r.test_file: r for r in results
+                        if r.test_file and self.ensure_coverage_installed(r.language)}
+        python_results = [r for r in by_test_file.values() if r.language == 'Python']
+        javascript_results = [r for r in by_test_file.values() if r.language == 'JavaScript']
+
+        if python_results:
+            try:
+                self.generate_python_coverage(python_results)
+            except Exception as e:
+                logging.error(f"Error generating Python coverage: {e}")
+        if javascript_results:
+            report_file = Path('generated_tests') / 'javascript' / 'coverage_report.txt'
+            try:
+                with open(report_file, 'w') as report:
+                    subprocess.run(
+                        ["jest", "--coverage", "--config=path/to/jest.config.js"] +
+                        [str(r.test_file) for r in javascript_results],
+                        stdout=report,
+                        check=True
+                    )
+                logging.info(f"Code coverage report saved to {report_file}")
+            except (OSError, subprocess.CalledProcessError) as e:
+                logging.error(f"Error generating JavaScript coverage: {e}")
+
+        for result in by_test_file.values():
+            if result.language not in ('Python', 'JavaScript'):
+                try:
+                    self.generate_coverage_report(result.test_file, result.language)
+                except Exception as e:
+                    logging.error(f"Error generating coverage for {result.file_name}: {e}")
+
+    @instrumented('generate_coverage_report')
+    def generate_python_coverage(self, results: List[FileResult]):
+        """Run Python tests under coverage once and write aggregate and per-source reports."""
+        output_dir = Path('generated_tests')
+        omit = "--omit=*/site-packages/*"
+        test_files = [str(r.test_file) for r in results]
+        jobs = max(1, min(self.options.coverage_jobs, len(test_files)))
+
+        subprocess.run([sys.executable, '-m', 'coverage', 'erase'], check=True)
+        # One broken generated file must not stop the others from being measured
+        pytest_args = ['-m', 'pytest', '-q', '--continue-on-collection-errors']
+        if jobs == 1:
+            commands = [[sys.executable, '-m', 'coverage', 'run', *pytest_args, *test_files]]
+        else:
+            commands = [[sys.executable, '-m', 'coverage', 'run', '--parallel-mode', *pytest_args,
+                         *test_files[i::jobs]] for i in range(jobs)]
+        logging.info(f"Running {len(test_files)} Python test files under coverage in {jobs} process(es)")
+        processes = [subprocess.Popen(command) for command in commands]
+        for process in processes:
+            # Exit code 1 only means some generated tests failed, which still yields coverage
+            if process.wait() not in (0, 1, 5):
+                logging.warning(f"pytest exited with code {process.returncode} during coverage run")
+        if jobs > 1:
+            subprocess.run([sys.executable, '-m', 'coverage', 'combine'], check=True)
+
+        json_file = output_dir / 'coverage.json'
+        report_file = output_dir / 'coverage_report.txt'
+        subprocess.run([sys.executable, '-m', 'coverage', 'json', '-o', str(json_file), omit], check=True)
+        with open(report_file, 'w') as report:
+            subprocess.run([sys.executable, '-m', 'coverage', 'report', '-m', omit],
+                           stdout=report, check=True)
+        logging.info(f"Aggregate coverage report saved to {report_file} and {json_file}")
+
+        with open(json_file, 'r') as f:
+            measured = json.load(f).get('files', {})
+        measured = {os.path.normpath(name): data for name, data in measured.items()}
+        for result in results:
+            report_file = result.test_file.parent / f"{result.test_file.stem}_coverage_report.txt"
+            data = measured.get(os.path.normpath(result.file_name))
+            with open(report_file, 'w') as report:
+                report.write(self.format_coverage_report(result.file_name, data))
+            logging.info(f"Code coverage report saved to {report_file}")
+
+    @staticmethod
+    def format_coverage_report(file_name: str, data: Optional[dict]) -> str:
+        """Render coverage.py JSON data for one file in the layout of `coverage report -m`."""
+        if not data:
+            return f"No coverage data was collected for {file_name}.\n"
+        summary = data['summary']
+        width = max(len('Name'), len(file_name))
+        return (
+            f"{'Name':<{width}}   Stmts   Miss  Cover   Missing\n"
+            f"{'-' * (width + 38)}\n"
+            f"{file_name:<{width}}   {summary['num_statements']:>5}  {summary['missing_lines']:>5}  "
+            f"{summary['percent_covered_display']:>4}%   {format_line_ranges(data.get('missing_lines', []))}".rstrip() + "\n"
+        )
+
+    def ensure_coverage_installed(self, language: str) -> bool:
         """
         Ensures that the appropriate coverage tool for the given programming language is installed.
-        Logs messages for each step.
+        The toolchain registry probes each language once and installs the tool if it is missing.
         """
-        try:
-            if language.lower() == 'python':
-                subprocess.check_call([sys.executable, '-m', 'pip', 'show', 'coverage'])
-                logging.info("Coverage tool for Python is already installed.")
-            elif language.lower() == 'javascript':
-                subprocess.check_call(['npm', 'list', 'jest'])
-                logging.info("Coverage tool for JavaScript (jest) is already installed.")
-            elif language.lower() == 'java':
-                logging.info("Ensure Jacoco is configured in your Maven/Gradle build.")
-            elif language.lower() == 'ruby':
-                subprocess.check_call(['gem', 'list', 'simplecov'])
-                logging.info("Coverage tool for Ruby (simplecov) is already installed.")
-            elif language.lower() == 'go':
-                logging.info("Go coverage is handled by the 'go test' command.")
-            else:
-                logging.warning(f"Coverage tool check is not configured for {language}. Please add it manually.")
-                return
+        return self.toolchains.available(language)
 
-        except subprocess.CalledProcessError:
-            logging.error(f"Coverage tool for {language} is not installed. Installing...")
-            try:
-                if language.lower() == 'python':
-                    subprocess.check_call([sys.executable, '-m', 'pip', 'install', 'coverage'])
-                    logging.info("Coverage tool for Python has been installed.")
-                elif language.lower() == 'javascript':
-                    subprocess.check_call(['npm', 'install', 'jest'])
-                    logging.info("Coverage tool for JavaScript (jest) has been installed.")
-                elif language.lower() == 'ruby':
-                    subprocess.check_call(['gem', 'install', 'simplecov'])
-                    logging.info("Coverage tool for Ruby (simplecov) has been installed.")
-                else:
-                    logging.error(f"Could not install coverage tool for {language} automatically. Please install manually.")
-            except subprocess.CalledProcessError:
-                logging.error(f"Failed to install the coverage tool for {language}. Please install it manually.")
+    def read_source(self, file_name: str, related: bool = False) -> str:
+        """Read a source file through the run's source cache, counting bytes read and reused.
+
+        Only related files count as reused: a file being processed is read
+        again by several stages, which is not sharing between prompts.
+        """
+        content, size, reused = self.sources.read(file_name)
+        if not reused:
+            self.metrics.add('bytes_read', size)
+        elif related:
+            self.metrics.add('bytes_reused', size)
+        return content
+
+    @instrumented('create_prompt', local=True)
+    def create_prompt(self, file_name: str, language: str, units: Optional[List[CodeUnit]] = None,
+                      existing_tests: Optional[List[str]] = None) -> Optional[str]:
+        """Create a language-specific prompt for test generation with accurate module and import names in related content.
 
-    def create_prompt(self, file_name: str, language: str) -> Optional[str]:
-        """Create a language-specific prompt for test generation with accurate module and import names in related content."""
+        When units is given, only those functions and classes are shown in
+        full and the rest of the module is reduced to its signatures.
+        """
         try:
-            with open(file_name, 'r') as f:
-                code_content = f.read()
+            code_content = self.read_source(file_name)
         except Exception as e:
             logging.error(f"Error reading file {file_name}: {e}")
             return None
 
+        code_section = code_content
+        if units is not None:
+            try:
+                header = python_module_header(code_content)
+            except (SyntaxError, ValueError):
+                header = ''
+            code_section = (
+                f"Only write tests for these functions and classes: {', '.join(unit.name for unit in units)}.\n\n"
+                + (f"Module imports and constants:\n\n{header}\n\n" if header else '')
+                + '\n\n'.join(unit.source.rstrip('\n') for unit in units)
+                + f"\n\nRest of the module (signatures only):\n\n{extract_signatures(code_content, language)}"
+            )
+            if existing_tests:
+                code_section += f"\n\nTests that already exist and must not be repeated: {', '.join(existing_tests)}"
+
         related_files = self.get_related_files(language, file_name)
-        related_content = ""
+        related_sources = {}
 
         if related_files:
             logging.info(f"Related files for {file_name}: {related_files}")
@@ -260,17 +2034,12 @@ class TestGenerator:
 
         for related_file in related_files:
             try:
-                with open(related_file, 'r') as rf:
-                    file_content = rf.read()
-                    module_path = str(Path(related_file).with_suffix('')).replace('/', '.')
-                    import_statement = f"import {module_path}"
-                    related_content += f"\n\n// Module: {module_path}\n{import_statement}\n{file_content}"
-                    logging.info(f"Included content from related file: {related_file} as module {module_path}")
+                related_sources[related_file] = self.read_source(related_file, related=True)
             except Exception as e:
                 logging.error(f"Error reading related file {related_file}: {e}")
 
         related_test_files = self.get_related_test_files(language, file_name)
-        related_test_content = ""
+        related_test_sources = {}
 
         if related_test_files:
             logging.info(f"Related Test files for {file_name}: {related_test_files}")
@@ -279,15 +2048,16 @@ class TestGenerator:
 
         for related_test_file in related_test_files:
             try:
-                with open(related_test_file, 'r') as rf:
-                    file_content = rf.read()
-                    related_test_content += f"\n\n// Related test file: {related_test_file}\n{file_content}"
-                    logging.info(f"Included content from related test file: {related_test_file}")
+                related_test_sources[related_test_file] = self.read_source(related_test_file, related=True)
             except Exception as e:
                 logging.error(f"Error reading related test file {related_test_file}: {e}")
 
         framework = self.get_test_framework(language)
-        prompt = f"""Generate comprehensive unit tests for the following {language} file: {file_name} using {framework}.
+
+        # Context shared between files comes first and the file under test last, so prompts of
+        # files with the same related modules share a prefix the provider can cache
+        def render(related_content: str, related_test_content: str) -> str:
+            return f"""Generate comprehensive unit tests for a {language} file using {framework}.
 
 Requirements:
 1. Include edge cases, normal cases, and error cases.
@@ -298,10 +2068,6 @@ Requirements:
 6. Ensure high code coverage.
 7. Test both success and failure scenarios.
 
-Code to test (File: {file_name}):
-
-{code_content}
-
 Related context:
 
 {related_content}
@@ -310,19 +2076,82 @@ Related test cases:
 
 {related_test_content}
 
-Generate only the test code without any explanations or notes."""
+Code to test (File: {file_name}):
+
+{code_section}
+
+Generate only the test code for {file_name} without any explanations or notes."""
 
-        logging.info(f"Created prompt for {file_name} with length {len(prompt)} characters")
+        related_content, related_test_content, full_tokens = self.fit_context(
+            language, render, related_sources, related_test_sources
+        )
+        prompt = render(related_content, related_test_content)
+
+        prompt_tokens = estimate_tokens(prompt)
+        logging.info(f"Created prompt for {file_name} with length {len(prompt)} characters "
+                     f"(~{prompt_tokens} tokens, {full_tokens - prompt_tokens} saved by the token budget)")
         return prompt
 
-    def call_openai_api(self, prompt: str) -> Optional[str]:
-        """Call OpenAI API to generate test cases."""
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {self.api_key}'
-        }
-        
-        data = {
+    def fit_context(self, language: str, render: Callable[[str, str], str], related_sources: Dict[str, str],
+                    related_test_sources: Dict[str, str]):
+        """Fill the prompt token budget with related context, most useful first.
+
+        The code under test is always included. Remaining room goes to the
+        public signatures of related modules, then related tests, then the
+        full source of related modules. Returns the related module content,
+        the related test content and the prompt's token count without a budget.
+        """
+        budget = self.options.prompt_tokens
+        remaining = budget - estimate_tokens(render("", "")) if budget > 0 else float('inf')
+        if remaining < 0:
+            logging.warning(f"Code under test alone exceeds the prompt budget of {budget} tokens")
+
+        def module_section(related_file: str, content: str, signatures_only: bool) -> str:
+            module_path = str(Path(related_file).with_suffix('')).replace('/', '.')
+            note = " (public signatures only)" if signatures_only else ""
+            return f"\n\n// Module: {module_path}{note}\nimport {module_path}\n{content}"
+
+        full_sections = {f: module_section(f, content, False) for f, content in related_sources.items()}
+        test_sections = {f: f"\n\n// Related test file: {f}\n{content}" for f, content in related_test_sources.items()}
+        full_tokens = estimate_tokens(render(''.join(full_sections.values()), ''.join(test_sections.values())))
+
+        chosen: Dict[str, str] = {}
+        for related_file, content in related_sources.items():
+            signatures = extract_signatures(content, language)
+            section = full_sections[related_file] if signatures == content else \
+                module_section(related_file, signatures, True)
+            cost = estimate_tokens(section)
+            if cost <= remaining:
+                chosen[related_file] = section
+                remaining -= cost
+            else:
+                logging.info(f"Skipped related file {related_file}: prompt budget exhausted")
+
+        chosen_tests = []
+        for related_test_file, section in test_sections.items():
+            cost = estimate_tokens(section)
+            if cost <= remaining:
+                chosen_tests.append(section)
+                remaining -= cost
+                logging.info(f"Included content from related test file: {related_test_file}")
+            else:
+                logging.info(f"Skipped related test file {related_test_file}: prompt budget exhausted")
+
+        for related_file, section in chosen.items():
+            extra = estimate_tokens(full_sections[related_file]) - estimate_tokens(section)
+            if section != full_sections[related_file] and extra <= remaining:
+                chosen[related_file] = full_sections[related_file]
+                remaining -= extra
+            logging.info(f"Included content from related file: {related_file}"
+                         f"{'' if chosen[related_file] == full_sections[related_file] else ' (signatures only)'}")
+
+        # Sorted, so prompts of files sharing related modules start with the same bytes
+        related_content = ''.join(chosen[f] for f in sorted(chosen))
+        return related_content, ''.join(chosen_tests), full_tokens
+
+    def build_request(self, prompt: str) -> dict:
+        """Chat completion request body for a prompt."""
+        return {
             'model': self.model,
             'messages': [
                 {
@@ -338,35 +2167,180 @@ Generate only the test code without any explanations or notes."""
             'temperature': 0.7
         }
 
+    def completion_key(self, prompt: str) -> str:
+        """Response cache key of the completion for a prompt."""
+        return ResponseCache.key(self.build_request(prompt))
+
+    @instrumented('call_openai_api')
+    def call_openai_api(self, prompt: str, use_cache: bool = True) -> Optional[str]:
+        """Call OpenAI API to generate test cases.
+
+        With use_cache=False the response cache is neither read nor written,
+        e.g. for repair requests, whose earlier answers already failed.
+        """
+        data = self.build_request(prompt)
+        cache_key = ResponseCache.key(data)
+        if use_cache and self.cache and not self.options.refresh:
+            cached_text = self.cache.get(cache_key)
+            if cached_text is not None:
+                logging.info(f"Using cached completion {cache_key[:12]}")
+                return self.normalize_completion(cached_text)
+
+        tokens = estimate_tokens(prompt) + self.max_tokens
+        self.rate_limiter.acquire(tokens)
+
         try:
-            response = requests.post(
-                'https://api.openai.com/v1/chat/completions',
-                headers=headers,
-                json=data,
-                timeout=60
-            )
-            response.raise_for_status()
-            generated_text = response.json()['choices'][0]['message']['content']
-            normalized_text = generated_text.replace('“', '"').replace('”', '"').replace("‘", "'").replace("’", "'")
-            if normalized_text.startswith('```'):
-                first_newline_index = normalized_text.find('\n', 3)
-                if first_newline_index != -1:
-                    normalized_text = normalized_text[first_newline_index+1:]
-                else:
-                    normalized_text = normalized_text[3:]
-                if normalized_text.endswith('```'):
-                    normalized_text = normalized_text[:-3]
-            return normalized_text.strip()
+            body = self.post_completion(data, tokens)
+            generated_text = body['choices'][0]['message']['content']
+            self.metrics.add_usage(body.get('usage'))
         except RequestException as e:
             logging.error(f"API request failed: {e}")
             return None
-        
-    def save_test_cases(self, file_name: str, test_cases: str, language: str) -> Optional[Path]:
-        """Save generated test cases to appropriate directory structure."""
-        tests_dir = Path('generated_tests')
-        tests_dir.mkdir(exist_ok=True)
-        lang_dir = tests_dir / language.lower()
-        lang_dir.mkdir(exist_ok=True)
+
+        if use_cache and self.cache and generated_text:
+            self.cache.put(cache_key, generated_text)
+        return self.normalize_completion(generated_text)
+
+    def timed_post(self, data: dict, cancel: Optional[threading.Event] = None) -> dict:
+        """POST a completion request and return its JSON body, recording the latency for its model."""
+        start = time.perf_counter()
+        response = self.client.post(f'{self.api_base}/chat/completions', data, cancel=cancel)
+        try:
+            body = response.json()
+        finally:
+            response.close()
+        if cancel is not None and cancel.is_set():
+            # Lost the race; its latency was recorded when it was cancelled, and what it cost is the overhead of hedging
+            self.metrics.add('hedge_wasted_requests')
+            self.metrics.add('hedge_wasted_tokens', (body.get('usage') or {}).get('total_tokens', 0))
+        else:
+            self.latency.record(data['model'], time.perf_counter() - start)
+        return body
+
+    def post_completion(self, data: dict, tokens: int) -> dict:
+        """Send a completion request, hedging it if it is still running at the model's latency deadline.
+
+        The duplicate goes to --fallback-model if set. The first valid answer
+        wins and the other request is cancelled: it is not retried, and an
+        answer it is still waiting for is discarded when it arrives.
+        """
+        self.metrics.add('completion_requests')
+        if not self.options.hedge:
+            return self.timed_post(data)
+
+        deadline = self.latency.deadline(data['model'], self.options.hedge_percentile, self.options.hedge_delay)
+        cancel = threading.Event()
+        start = time.perf_counter()
+        primary = self.hedge_executor.submit(self.timed_post, data, cancel)
+        if wait([primary], timeout=deadline).done:
+            return primary.result()
+
+        fallback = self.options.fallback_model or data['model']
+        logging.info(f"Request to {data['model']} still running after {deadline:.1f}s, hedging with {fallback}")
+        self.metrics.add('hedged_requests')
+        self.rate_limiter.acquire(tokens)
+        hedge_start = time.perf_counter()
+        hedge = self.hedge_executor.submit(self.timed_post, dict(data, model=fallback), cancel)
+
+        pending = {primary, hedge}
+        answer, error = None, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    body = future.result()
+                    content = body['choices'][0]['message']['content']
+                except (RequestException, ValueError, KeyError, IndexError, TypeError) as e:
+                    error = e
+                    continue
+                answer = body
+                if content:
+                    cancel.set()
+                    for loser in pending:
+                        loser.cancel()
+                        # The loser took at least this long; leaving it out would hide exactly the slow tail
+                        if loser is primary:
+                            self.latency.record(data['model'], time.perf_counter() - start)
+                        else:
+                            self.latency.record(fallback, time.perf_counter() - hedge_start)
+                    if future is hedge:
+                        self.metrics.add('hedge_wins')
+                    return body
+        if answer is not None:
+            return answer
+        raise error
+
+    def stream_openai_api(self, prompt: str) -> Iterator[str]:
+        """Stream test cases from the OpenAI API, yielding normalized text as it arrives.
+
+        Raises StreamAborted when the output exceeds --max-output-bytes,
+        starts with a refusal instead of code, or is empty.
+        """
+        data = self.build_request(prompt)
+        cache_key = ResponseCache.key(data)
+        if self.cache and not self.options.refresh:
+            cached_text = self.cache.get(cache_key)
+            if cached_text is not None:
+                logging.info(f"Using cached completion {cache_key[:12]}")
+                yield self.normalize_completion(cached_text)
+                return
+
+        self.rate_limiter.acquire(estimate_tokens(prompt) + self.max_tokens)
+        start = time.perf_counter()
+        stream_data = dict(data, stream=True, stream_options={'include_usage': True})
+        response = self.client.post(f'{self.api_base}/chat/completions', stream_data, stream=True)
+
+        normalizer = StreamNormalizer()
+        raw_chunks = []
+        received = 0
+        first_line = ''
+        checked = False
+        try:
+            for content in iter_sse_content(response, self.metrics.add_usage):
+                raw_chunks.append(content)
+                received += len(content.encode('utf-8'))
+                if received > self.options.max_output_bytes:
+                    raise StreamAborted(f"completion exceeded {self.options.max_output_bytes} bytes")
+                text = normalizer.feed(content)
+                if not checked and text:
+                    first_line += text
+                    if '\n' in first_line or len(first_line) >= 200:
+                        checked = True
+                        if REFUSAL_PATTERN.match(first_line):
+                            raise StreamAborted(f"completion is not code: {first_line.splitlines()[0][:80]!r}")
+                if text:
+                    yield text
+            text = normalizer.finish()
+            if not normalizer.started:
+                raise StreamAborted("completion was empty")
+            if not checked and REFUSAL_PATTERN.match(first_line + text):
+                raise StreamAborted(f"completion is not code: {(first_line + text)[:80]!r}")
+            if text:
+                yield text
+        finally:
+            response.close()
+            # Includes the time spent writing chunks, which overlaps the download
+            self.metrics.record('call_openai_api', time.perf_counter() - start)
+
+        if self.cache:
+            self.cache.put(cache_key, ''.join(raw_chunks))
+
+    def normalize_completion(self, generated_text: str) -> str:
+        """Normalize typographic quotes and strip a surrounding Markdown code fence."""
+        normalized_text = generated_text.replace('“', '"').replace('”', '"').replace("‘", "'").replace("’", "'")
+        if normalized_text.startswith('```'):
+            first_newline_index = normalized_text.find('\n', 3)
+            if first_newline_index != -1:
+                normalized_text = normalized_text[first_newline_index+1:]
+            else:
+                normalized_text = normalized_text[3:]
+            if normalized_text.endswith('```'):
+                normalized_text = normalized_text[:-3]
+        return normalized_text.strip()
+
+    def get_test_file_path(self, file_name: str, language: str) -> Path:
+        """Return the path the generated tests for a source file are saved to."""
+        lang_dir = Path('generated_tests') / language.lower()
         base_name = Path(file_name).stem
         extension = Path(file_name).suffix
 
@@ -384,26 +2358,46 @@ Generate only the test code without any explanations or notes."""
             if not base_name.startswith("test_"):
                 base_name = f"test_{base_name}"
 
-        test_file = lang_dir / f"{base_name}{extension}"
+        return lang_dir / f"{base_name}{extension}"
+
+    @instrumented('save_test_cases')
+    def save_test_cases(self, file_name: str, test_cases: Union[str, Iterable[str]], language: str) -> Optional[Path]:
+        """Save generated test cases to appropriate directory structure.
+
+        test_cases may also be an iterable of chunks, which are written to a
+        temporary file as they are produced and moved over the test file once
+        complete. If it fails part way, only the temporary file is removed and
+        an existing test file is left as it was.
+        """
+        test_file = self.get_test_file_path(file_name, language)
+        test_file.parent.mkdir(parents=True, exist_ok=True)
         header = ""
 
         if language.lower() == 'python':
-            header = (
-                "import sys\n"
-                "import os\n"
-                "sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))\n\n"
-            )
+            header = PYTHON_TEST_HEADER
         elif language.lower() == 'go':
             # Include any Go-specific setup code here, if necessary
             test_dir = Path(file_name).parent
             test_file_name = f"{Path(file_name).stem}_test.go"
 
+        tmp_name = None
         try:
-            with open(test_file, 'w', encoding='utf-8') as f:
-                f.write(header + test_cases)
+            if isinstance(test_cases, str):
+                with open(test_file, 'w', encoding='utf-8') as f:
+                    f.write(header + test_cases)
+            else:
+                fd, tmp_name = tempfile.mkstemp(dir=test_file.parent, prefix='.tmp-')
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    f.write(header)
+                    for chunk in test_cases:
+                        f.write(chunk)
+                        f.flush()
+                replace_file(tmp_name, test_file)
             logging.info(f"Test cases saved to {test_file}")
         except Exception as e:
             logging.error(f"Error saving test cases to {test_file}: {e}")
+            if tmp_name:
+                Path(tmp_name).unlink(missing_ok=True)
             return None
 
         if test_file.exists():
@@ -413,44 +2407,637 @@ Generate only the test code without any explanations or notes."""
             logging.error(f"File {test_file} was not created.")
             return None
 
-    def run(self):
-        """Main execution method."""
-        changed_files = self.get_changed_files()
+    @staticmethod
+    def git_path(file_name: str) -> str:
+        """A path for git's <rev>:<path> syntax, relative to the working directory."""
+        path = Path(file_name).as_posix()
+        if not path.startswith(('/', './', '../')):
+            path = f"./{path}"
+        return path
+
+    def get_changed_lines(self, file_name: str) -> Optional[List[Tuple[int, int]]]:
+        """Line ranges of a file added or modified since --base-ref, or None if git cannot tell.
+
+        A hunk that only deletes lines is reported as the line before the
+        deletion, so the function or class it was deleted from counts as changed.
+        """
+        base = self.options.base_ref
+        path = self.git_path(file_name)
+        try:
+            known = subprocess.run(['git', 'cat-file', '-e', f"{base}:{path}"], capture_output=True)
+            if known.returncode != 0:
+                logging.info(f"{file_name} does not exist at {base}")
+                return None
+            diff = subprocess.run(['git', 'diff', '-U0', '--no-color', '--no-ext-diff', base, '--', file_name],
+                                  capture_output=True, text=True, check=True).stdout
+        except (OSError, subprocess.CalledProcessError) as e:
+            logging.warning(f"Could not diff {file_name} against {base}: {e}")
+            return None
+
+        ranges = []
+        for match in re.finditer(r'^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@', diff, re.MULTILINE):
+            start = int(match.group(1))
+            count = int(match.group(2)) if match.group(2) is not None else 1
+            if count:
+                ranges.append((start, start + count - 1))
+            else:
+                ranges.append((max(start, 1), max(start, 1)))
+        return ranges
+
+    def get_removed_units(self, file_name: str, units: List[CodeUnit]) -> Optional[List[str]]:
+        """Top-level functions and classes at --base-ref that are gone from units, or None if git cannot tell."""
+        try:
+            base_source = subprocess.run(['git', 'show', f"{self.options.base_ref}:{self.git_path(file_name)}"],
+                                         capture_output=True, text=True, check=True).stdout
+            base_units = python_code_units(base_source)
+        except (OSError, subprocess.CalledProcessError, SyntaxError, ValueError) as e:
+            logging.warning(f"Could not read {file_name} at {self.options.base_ref}: {e}")
+            return None
+        names = {unit.name for unit in units}
+        return [unit.name for unit in base_units if unit.name not in names]
+
+    def get_changed_units(self, file_name: str) -> Optional[List[CodeUnit]]:
+        """Top-level functions and classes touched since --base-ref.
+
+        Returns None when the whole file should be covered instead: it is
+        new, git cannot diff it, a function or class was removed or renamed
+        (its existing tests would refer to a name that no longer exists), or
+        module-level code outside any function or class changed. Blank and
+        comment-only lines outside them, such as the blank lines above a new
+        function, do not count as code.
+        """
+        changed = self.get_changed_lines(file_name)
+        if changed is None:
+            return None
+        try:
+            source = self.read_source(file_name)
+            units = python_code_units(source)
+        except (OSError, SyntaxError, ValueError) as e:
+            logging.warning(f"Could not parse {file_name} for incremental generation: {e}")
+            return None
+
+        removed = self.get_removed_units(file_name, units)
+        if removed is None:
+            return None
+        if removed:
+            logging.info(f"{removed} removed or renamed in {file_name}, generating tests for the whole file")
+            return None
+
+        lines = source.splitlines()
+        selected = []
+        for start, end in changed:
+            touched = [u for u in units if u.start <= end and start <= u.end]
+            module_level = [
+                number for number in range(start, min(end, len(lines)) + 1)
+                if not any(u.start <= number <= u.end for u in touched)
+                and lines[number - 1].strip() and not lines[number - 1].lstrip().startswith('#')
+            ]
+            if module_level:
+                logging.info(f"Module-level code in {file_name} changed, generating tests for the whole file")
+                return None
+            selected.extend(u for u in touched if u not in selected)
+        return sorted(selected, key=lambda unit: unit.start)
+
+    @instrumented('save_test_cases')
+    def merge_test_cases(self, file_name: str, test_cases: str, language: str) -> Optional[Path]:
+        """Merge generated tests into the existing test file for a source file."""
+        test_file = self.get_test_file_path(file_name, language)
+        try:
+            with open(test_file, 'r', encoding='utf-8') as f:
+                existing = f.read()
+            merged = merge_test_modules(existing, test_cases)
+        except (OSError, SyntaxError, ValueError) as e:
+            logging.error(f"Could not merge generated tests into {test_file}: {e}")
+            return None
+        try:
+            atomic_write_text(test_file, merged)
+        except OSError as e:
+            logging.error(f"Error saving test cases to {test_file}: {e}")
+            return None
+        logging.info(f"Merged new test cases into {test_file}")
+        return test_file
+
+    def get_chunks(self, file_name: str) -> Optional[List[List[CodeUnit]]]:
+        """Chunks of a Python file too large for one prompt, or None if it fits."""
+        try:
+            source = self.read_source(file_name)
+            if estimate_tokens(source) <= self.options.chunk_tokens:
+                return None
+            units = python_code_units(source)
+        except (OSError, SyntaxError, ValueError) as e:
+            logging.warning(f"Could not split {file_name} into chunks: {e}")
+            return None
+        chunks = plan_chunks(units, self.options.chunk_tokens)
+        return chunks if len(chunks) > 1 else None
+
+    def generate_chunked(self, file_name: str, language: str, chunks: List[List[CodeUnit]],
+                         cache_keys: Optional[List[str]] = None) -> Optional[str]:
+        """Generate tests for each chunk concurrently and merge them into one test module.
+
+        The cache keys of the chunk completions are added to cache_keys.
+        """
+        logging.info(f"Splitting {file_name} into {len(chunks)} chunks")
+
+        def generate(chunk: List[CodeUnit]) -> Optional[str]:
+            try:
+                prompt = self.create_prompt(file_name, language, chunk)
+                if not prompt:
+                    return None
+                if cache_keys is not None:
+                    cache_keys.append(self.completion_key(prompt))
+                return self.call_openai_api(prompt)
+            except Exception as e:
+                logging.error(f"Error generating tests for {[unit.name for unit in chunk]} in {file_name}: {e}")
+                return None
+
+        merged = None
+        for index, output in enumerate(self.chunk_executor.map(generate, chunks), 1):
+            if not output:
+                logging.error(f"Chunk {index}/{len(chunks)} of {file_name} produced no tests")
+                continue
+            try:
+                if merged is None:
+                    ast.parse(output)
+                    merged = output
+                else:
+                    merged = merge_test_modules(merged, output)
+            except (SyntaxError, ValueError) as e:
+                logging.error(f"Discarding tests for chunk {index}/{len(chunks)} of {file_name}: {e}")
+        return merged
+
+    def prepare_toolchain(self, language: str):
+        """Make sure the coverage tool for a language is available, unless coverage is disabled."""
+        if self.options.no_coverage:
+            return
+        with self.metrics.stage('prepare_toolchain'):
+            self.ensure_coverage_installed(language)
+
+    def process_file(self, file_name: str) -> FileResult:
+        """Generate and save tests for one file. Errors are contained to that file."""
+        result = FileResult(file_name)
+        start = time.perf_counter()
+        try:
+            language = self.detect_language(file_name)
+            result.language = language
+            if language == 'Unknown':
+                logging.warning(f"Unsupported file type: {file_name}")
+                result.skipped = True
+                return result
+
+            logging.info(f"Processing {file_name} ({language})")
+            units = None
+            existing_tests = None
+            test_file = self.get_test_file_path(file_name, language)
+            if self.options.incremental and language == 'Python' and test_file.exists():
+                units = self.get_changed_units(file_name)
+                if units is not None and not units:
+                    logging.info(f"No changed functions or classes in {file_name}, keeping {test_file}")
+                    result.skipped = True
+                    return result
+                if units is not None:
+                    logging.info(f"Incremental generation for {file_name}: {[unit.name for unit in units]}")
+                    try:
+                        existing_tests = [unit.name for unit in python_code_units(test_file.read_text())]
+                    except (OSError, SyntaxError, ValueError):
+                        existing_tests = None
+
+            chunks = None
+            if units is None and language == 'Python' and self.options.chunk_tokens > 0:
+                chunks = self.get_chunks(file_name)
+
+            if chunks:
+                test_cases = self.generate_chunked(file_name, language, chunks, result.cache_keys)
+            else:
+                prompt = self.create_prompt(file_name, language, units, existing_tests)
+                if not prompt:
+                    result.error = "could not create prompt"
+                    return result
+                result.cache_keys.append(self.completion_key(prompt))
+
+                if self.options.stream and units is None:
+                    self.prepare_toolchain(language)
+                    result.test_file = self.save_test_cases(file_name, self.stream_openai_api(prompt), language)
+                    if not result.test_file:
+                        logging.error(f"Failed to generate test cases for {file_name}")
+                        result.error = "streamed generation failed"
+                    return result
+
+                test_cases = self.call_openai_api(prompt)
+            if not test_cases:
+                logging.error(f"Failed to generate test cases for {file_name}")
+                result.error = "no test cases generated"
+                return result
+
+            test_cases = test_cases.replace("“", '"').replace("”", '"')
+            self.prepare_toolchain(language)
+
+            if units is not None:
+                result.test_file = self.merge_test_cases(file_name, test_cases, language)
+            else:
+                result.test_file = self.save_test_cases(file_name, test_cases, language)
+            if not result.test_file:
+                result.error = "could not save test cases"
+        except Exception as e:
+            logging.error(f"Error processing {file_name}: {e}")
+            result.error = str(e)
+        finally:
+            result.seconds = time.perf_counter() - start
+        return result
+
+    def run_generated_tests(self, test_file: Path) -> Tuple[bool, str]:
+        """Compile a generated Python test file and run it under pytest.
+
+        Returns whether it passed (expected failures count as passing) and
+        the error output if it did not.
+        """
+        try:
+            source = test_file.read_text(encoding='utf-8')
+            tree = compile(source, str(test_file), 'exec', ast.PyCF_ONLY_AST)
+            compile(tree, str(test_file), 'exec')
+        except (OSError, SyntaxError, ValueError) as e:
+            return False, f"{type(e).__name__}: {e}"
+
+        test_count = sum(1 for node in ast.walk(tree)
+                         if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.name.startswith('test'))
+        command = [sys.executable, '-m', 'pytest', '-q', '--tb=short', '-p', 'no:cacheprovider', str(test_file)]
+        if importlib.util.find_spec('pytest_timeout'):
+            command.insert(-1, f'--timeout={self.options.test_timeout}')
+        timeout = self.options.test_timeout * max(1, test_count)
+        try:
+            completed = subprocess.run(command, capture_output=True, text=True, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return False, f"The tests did not finish within {timeout:.0f} seconds."
+        if completed.returncode == 0:
+            return True, ''
+        output = completed.stdout + completed.stderr
+        if completed.returncode == 5:
+            output = "No tests were collected.\n" + output
+        return False, output[-REPAIR_OUTPUT_CHARS:]
+
+    def create_repair_prompt(self, file_name: str, test_file: Path, error_output: str) -> Optional[str]:
+        """Create a prompt asking for a corrected version of a failing generated test file."""
+        try:
+            code_content = self.read_source(file_name)
+            test_content = test_file.read_text(encoding='utf-8')
+        except OSError as e:
+            logging.error(f"Error reading files to repair {test_file}: {e}")
+            return None
+        # save_test_cases adds the header again
+        if test_content.startswith(PYTHON_TEST_HEADER):
+            test_content = test_content[len(PYTHON_TEST_HEADER):]
+
+        return f"""The following pytest tests for {file_name} fail. Fix them.
+
+Requirements:
+1. Fix imports, syntax errors, fixtures and wrong expectations in the tests.
+2. If a test fails because the code under test has a real bug, keep the test and mark it with @pytest.mark.xfail(reason="<the bug>", strict=True).
+3. Keep every other test as it is.
+
+Code under test (File: {file_name}):
+
+{code_content}
+
+Test file:
+
+{test_content}
+
+pytest output:
+
+{error_output}
+
+Generate only the complete corrected test code without any explanations or notes."""
+
+    def validate_tests(self, result: FileResult, previous_tests: Optional[str]) -> FileResult:
+        """Run a generated Python test file, asking for repairs until it passes or --repair-rounds run out.
+
+        Tests that still fail are dropped: the test file goes back to what it
+        was before this run, or is removed if this run created it, and the
+        completions they came from are removed from the response cache so the
+        next run asks again instead of replaying them.
+        """
+        test_file = result.test_file
+        try:
+            with self.metrics.stage('validate_tests'):
+                passed, output = self.run_generated_tests(test_file)
+            while not passed and result.repairs < self.options.repair_rounds:
+                result.repairs += 1
+                logging.info(f"Generated tests in {test_file} failed, "
+                             f"repair round {result.repairs} of {self.options.repair_rounds}")
+                prompt = self.create_repair_prompt(result.file_name, test_file, output)
+                repaired = self.call_openai_api(prompt, use_cache=False) if prompt else None
+                if not repaired or not self.save_test_cases(result.file_name, repaired, result.language):
+                    break
+                with self.metrics.stage('validate_tests'):
+                    passed, output = self.run_generated_tests(test_file)
+        except Exception as e:
+            # A broken validation setup must not throw away tests
+            logging.error(f"Error validating {test_file}: {e}")
+            result.validation = 'error'
+            self.metrics.add('tests_validation_errors')
+            return result
+
+        self.metrics.add('repair_rounds', result.repairs)
+        if passed:
+            result.validation = 'repaired' if result.repairs else 'passed'
+            repairs = f" after {result.repairs} repair round(s)" if result.repairs else ""
+            logging.info(f"Generated tests in {test_file} pass{repairs}")
+        else:
+            result.validation = 'failed'
+            last_line = (output.strip().splitlines() or ['no output'])[-1]
+            logging.error(f"Dropping generated tests in {test_file}, still failing: {last_line}")
+            result.error = f"generated tests failed validation: {last_line}"
+            result.test_file = None
+            try:
+                if previous_tests is None:
+                    test_file.unlink()
+                else:
+                    atomic_write_text(test_file, previous_tests)
+            except OSError as e:
+                logging.error(f"Error removing failing tests {test_file}: {e}")
+            if self.cache:
+                for key in result.cache_keys:
+                    self.cache.delete(key)
+        self.metrics.add(f'tests_{result.validation}')
+        return result
+
+    def validate_and_report(self, result: FileResult, previous_tests: Optional[str],
+                            on_result: Optional[Callable[[FileResult], None]]) -> FileResult:
+        self.validate_tests(result, previous_tests)
+        if on_result:
+            on_result(result)
+        return result
+
+    def process_group(self, file_names: List[str],
+                      on_result: Optional[Callable[[FileResult], None]] = None) -> List[FileResult]:
+        """Process files that share a test file path one after another, in input order.
+
+        With --validate the final test file is handed to the validation pool
+        and this worker moves on to generating the next group.
+        """
+        validate = self.options.validate and self.detect_language(file_names[-1]) == 'Python'
+        previous_tests = None
+        if validate:
+            try:
+                previous_tests = self.get_test_file_path(file_names[-1], 'Python').read_text(encoding='utf-8')
+            except OSError:
+                previous_tests = None
+
+        results = []
+        for file_name in file_names:
+            result = self.process_file(file_name)
+            results.append(result)
+            if validate and file_name == file_names[-1] and result.test_file:
+                # on_result runs inside the task rather than as a done callback, which could run
+                # after run() has already seen the future finish and returned
+                self._validations.append(self.validation_executor.submit(
+                    self.validate_and_report, result, previous_tests, on_result))
+            elif on_result:
+                on_result(result)
+        return results
+
+    def run(self, changed_files: Optional[List[str]] = None,
+            on_result: Optional[Callable[[FileResult], None]] = None) -> List[FileResult]:
+        """Main execution method.
+
+        changed_files defaults to the files given on the command line.
+        on_result is called from worker threads as each file finishes.
+        """
+        if changed_files is None:
+            changed_files = self.get_changed_files()
+        else:
+            changed_files = list(dict.fromkeys(changed_files))
         if not changed_files:
             logging.info("No files changed.")
-            return
+            return []
 
+        # Skip the test generation script itself
+        changed_files = [f for f in changed_files if f != "generate_tests.py"]
+
+        # Files whose tests land in the same file are kept in one group so the
+        # last one in input order always wins, exactly as in a serial run.
+        groups: Dict[Path, List[str]] = {}
         for file_name in changed_files:
-            if file_name == "generate_tests.py":
-                continue  # Skip the test generation script itself
+            key = self.get_test_file_path(file_name, self.detect_language(file_name))
+            groups.setdefault(key, []).append(file_name)
+
+        if self.options.shard:
+            groups = self.select_shard(groups)
+            selected = {file_name for files in groups.values() for file_name in files}
+            changed_files = [f for f in changed_files if f in selected]
+
+        if not self.options.no_coverage:
+            # Probe every language in the change set at once, while generation gets going
+            self.toolchains.probe({self.detect_language(f) for f in changed_files})
+
+        logging.info(f"Generating tests for {len(changed_files)} files with {self.workers} workers")
+        results_by_file: Dict[str, FileResult] = {}
+        self._validations = []
+        self.sources = SourceCache()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for group_results in executor.map(lambda files: self.process_group(files, on_result), groups.values()):
+                for result in group_results:
+                    results_by_file[result.file_name] = result
+        # Validation overlaps with generation; only the tail is waited for here
+        for future in self._validations:
+            future.result()
+        self.latency.save()
+        results = [results_by_file[file_name] for file_name in changed_files]
+
+        if not self.options.no_coverage:
+            self.generate_coverage_reports(results)
+        self.log_run_summary(results)
+        self.write_metrics(results)
+        if self.options.shard:
+            self.write_shard_output(results)
+        return results
+
+    def estimate_cost(self, file_name: str) -> int:
+        """Rough cost of generating tests for a file: the bytes of the file and of the context sent with it."""
+        def size(path: str) -> int:
             try:
-                language = self.detect_language(file_name)
-                if language == 'Unknown':
-                    logging.warning(f"Unsupported file type: {file_name}")
-                    continue
+                return os.path.getsize(path)
+            except OSError:
+                return 0
 
-                logging.info(f"Processing {file_name} ({language})")
-                prompt = self.create_prompt(file_name, language)
-                
-                if prompt:
-                    test_cases = self.call_openai_api(prompt)
-                    
-                    if test_cases:
-                        test_cases = test_cases.replace("“", '"').replace("”", '"')
-                        self.ensure_coverage_installed(language)
-
-                        test_file = self.save_test_cases(file_name, test_cases, language)
-                        if test_file:
-                            self.generate_coverage_report(test_file, language)
-                    else:
-                        logging.error(f"Failed to generate test cases for {file_name}")
+        language = self.detect_language(file_name)
+        context = sum(size(f) for f in self.get_related_files(language, file_name))
+        context += sum(size(f) for f in self.get_related_test_files(language, file_name))
+        if self.options.prompt_tokens > 0:
+            context = min(context, self.options.prompt_tokens * 4)
+        return size(file_name) + context
+
+    def select_shard(self, groups: Dict[Path, List[str]]) -> Dict[Path, List[str]]:
+        """The groups of files this shard processes, from a cost-balanced partition all shards agree on."""
+        index, count = self.options.shard
+        keys = list(groups)
+        costs = [sum(self.estimate_cost(f) for f in groups[key]) for key in keys]
+        assignment = partition_by_cost(costs, count)
+        loads = [0] * count
+        for cost, shard in zip(costs, assignment):
+            loads[shard] += cost
+        selected = {key: groups[key] for key, shard in zip(keys, assignment) if shard == index - 1}
+        self.shard_info = {'index': index, 'count': count, 'files': sum(len(files) for files in selected.values()),
+                           'cost': loads[index - 1], 'total_cost': sum(loads)}
+        logging.info(f"Shard {index}/{count}: {self.shard_info['files']} of {sum(len(f) for f in groups.values())} "
+                     f"files, estimated cost {loads[index - 1]} (shard costs: {loads})")
+        return selected
+
+    def write_shard_output(self, results: List[FileResult]):
+        """Leave this shard's run report, coverage data and a manifest of written test files in --shard-output.
+
+        Aggregate coverage reports are left out of the manifest; the merge
+        step rebuilds them from the combined coverage data.
+        """
+        output = Path(self.options.shard_output)
+        written = sorted({Path(os.path.relpath(r.test_file, 'generated_tests')).as_posix()
+                          for r in results if r.test_file})
+        try:
+            atomic_write_text(output / 'manifest.json', json.dumps({'files': written}, indent=2))
+            atomic_write_text(output / 'metrics.json', json.dumps(self.run_report(results), indent=2))
+            measured = any(r.test_file and r.language == 'Python' for r in results)
+            if not self.options.no_coverage and measured and Path('.coverage').exists():
+                shutil.copy2('.coverage', output / 'coverage.data')
+            logging.info(f"Shard output saved to {output}")
+        except OSError as e:
+            logging.error(f"Error writing shard output to {output}: {e}")
+
+    def for_request(self, overrides: dict) -> 'TestGenerator':
+        """Shallow copy sharing the warm index, cache, HTTP pool and toolchain state, with per-request options."""
+        worker = copy.copy(self)
+        worker.options = argparse.Namespace(**dict(vars(self.options), **overrides))
+        worker.metrics = Metrics()
+        return worker
+
+    def watch(self, stop: threading.Event):
+        """Keep the project index current while the daemon runs."""
+        while not stop.wait(self.options.watch_interval):
+            try:
+                with self._index_lock:
+                    if self._project_index is not None:
+                        self._project_index.refresh()
             except Exception as e:
-                logging.error(f"Error processing {file_name}: {e}")
+                logging.error(f"Error refreshing the project index: {e}")
+
+    def serve(self):
+        """Serve test generation requests on a Unix socket until stopped."""
+        socket_path = self.options.socket
+        if os.path.exists(socket_path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                try:
+                    probe.connect(socket_path)
+                except OSError:
+                    os.unlink(socket_path)  # Left behind by a daemon that did not exit cleanly
+                else:
+                    raise RuntimeError(f"A daemon is already listening on {socket_path}")
+        os.makedirs(os.path.dirname(socket_path) or '.', exist_ok=True)
+
+        # Warm up before accepting requests
+        self.project_index
+
+        stop = threading.Event()
+        watcher = threading.Thread(target=self.watch, args=(stop,), daemon=True)
+        watcher.start()
+        server = TestGeneratorDaemon(socket_path, self)
+        logging.info(f"Test generation daemon listening on {socket_path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stop.set()
+            server.server_close()
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            logging.info("Test generation daemon stopped")
+
+    def run_report(self, results: List[FileResult]) -> dict:
+        """Machine-readable report of the run: stage timings, counters and per-file outcomes."""
+        generated = sum(1 for r in results if r.test_file)
+        skipped = sum(1 for r in results if r.skipped)
+        extra = {
+            'files': {'total': len(results), 'generated': generated, 'skipped': skipped,
+                      'failed': len(results) - generated - skipped},
+            'api': self.client.stats(),
+            'toolchains': self.toolchains.stats(),
+            'latency': self.latency.summary(),
+            'per_file': [{'file': r.file_name, 'language': r.language, 'seconds': round(r.seconds, 6),
+                          'test_file': str(r.test_file) if r.test_file else None, 'error': r.error,
+                          'validation': r.validation, 'repairs': r.repairs}
+                         for r in results]
+        }
+        if self.cache:
+            extra['cache'] = {'hits': self.cache.hits, 'misses': self.cache.misses,
+                              'writes': self.cache.writes, 'evictions': self.cache.evictions}
+        if self.shard_info:
+            extra['shard'] = self.shard_info
+        return self.metrics.report(extra)
+
+    def write_metrics(self, results: List[FileResult]):
+        """Write the run report and profile to the locations given on the command line."""
+        report = self.run_report(results)
+        try:
+            if self.options.metrics_json:
+                atomic_write_text(Path(self.options.metrics_json), json.dumps(report, indent=2))
+                logging.info(f"Run report saved to {self.options.metrics_json}")
+            if self.options.prometheus_file:
+                atomic_write_text(Path(self.options.prometheus_file), Metrics.format_prometheus(report))
+                logging.info(f"Prometheus metrics saved to {self.options.prometheus_file}")
+            self.metrics.save_profile()
+        except OSError as e:
+            logging.error(f"Error writing run metrics: {e}")
+
+    def log_run_summary(self, results: List[FileResult]):
+        """Log a one-line summary of the run followed by the outcome for each file."""
+        generated = sum(1 for r in results if r.test_file)
+        skipped = sum(1 for r in results if r.skipped)
+        failed = len(results) - generated - skipped
+        logging.info(f"Run summary: {len(results)} files, {generated} generated, {failed} failed, {skipped} skipped")
+        stats = self.client.stats()
+        logging.info(f"API: {stats['requests']} requests, {stats['retries']} retries, "
+                     f"{stats['new_connections']} new connections, {stats['reused_connections']} reused")
+        for name, stage in sorted(self.metrics.stages.items()):
+            logging.info(f"Stage {name}: {stage['calls']} calls, {stage['seconds']:.3f}s total")
+        if self.cache:
+            logging.info(f"Cache: {self.cache.hits} hits, {self.cache.misses} misses, "
+                         f"{self.cache.writes} writes, {self.cache.evictions} evictions")
+        hedged = self.metrics.counters.get('hedged_requests', 0)
+        if hedged:
+            sent = self.metrics.counters.get('completion_requests', 0)
+            logging.info(f"Hedging: {hedged:.0f} extra requests for {sent:.0f} completions "
+                         f"({100 * hedged / max(1, sent):.1f}% overhead), "
+                         f"{self.metrics.counters.get('hedge_wins', 0):.0f} won by the duplicate, "
+                         f"{self.metrics.counters.get('hedge_wasted_tokens', 0):.0f} tokens spent on cancelled requests")
+        counters = self.metrics.counters
+        logging.info(f"Sources: {counters.get('bytes_read', 0):.0f} bytes read, "
+                     f"{counters.get('bytes_reused', 0):.0f} reused from earlier prompts; "
+                     f"{counters.get('cached_prompt_tokens', 0):.0f} of {counters.get('prompt_tokens', 0):.0f} "
+                     f"prompt tokens served from the API's prompt cache")
+        toolchains = self.toolchains.stats()
+        if toolchains['available']:
+            logging.info(f"Toolchains: {toolchains['probes']} probed, {toolchains['cache_hits']} known from earlier runs, "
+                         f"available: {toolchains['available']}")
+        for result in results:
+            if result.test_file and result.validation:
+                logging.info(f"  {result.file_name}: {result.test_file} ({result.validation})")
+            elif result.test_file:
+                logging.info(f"  {result.file_name}: {result.test_file}")
+            elif result.skipped:
+                logging.info(f"  {result.file_name}: skipped")
+            else:
+                logging.info(f"  {result.file_name}: failed ({result.error})")
 
 if __name__ == '__main__':
     try:
-        generator = TestGenerator()
-        generator.run()
+        options = parse_args()
+        if options.connect or options.stop:
+            sys.exit(run_client(options))
+        if options.merge:
+            sys.exit(merge_shards(options))
+        generator = TestGenerator(options)
+        if options.serve:
+            generator.serve()
+        else:
+            generator.run()
     except Exception as e:
         logging.error(f"Fatal error: {e}")
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
@@ -0,0 +1,251 @@
+import json
+import time
+import hashlib
+import random
+import logging
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+DEFAULT_COMPLETION = '''```python
+import pytest
+
+
+def test_placeholder():
+    """Generated by the mock completions server."""
+    assert True
+```'''
+
+
+class MockCompletionsHandler(BaseHTTPRequestHandler):
+    """Serves a canned chat completion for POST /v1/chat/completions.
+
+    Requests with "stream": true get the completion as server-sent events.
+    A configurable share of requests fails with an error status instead, and
+    another share is answered after a much longer delay to simulate tail latency.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug(f"mock server: {format % args}")
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_error(404)
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            payload = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self.send_error(400)
+            return
+
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+            request_id = f"chatcmpl-mock-{server.request_count}"
+            latency = server.model_latency.get(payload.get('model'), server.latency)
+            prompt_chars = sum(len(m.get('content', '')) for m in payload.get('messages', []))
+            latency += server.latency_per_1k_tokens * prompt_chars / 4000
+            latency = max(0.0, latency + server.random.uniform(-server.jitter, server.jitter))
+            if server.random.random() < server.slow_rate:
+                latency = server.slow_latency
+                server.slow_count += 1
+            fail = server.random.random() < server.error_rate
+        if latency > 0:
+            time.sleep(latency)
+
+        if fail:
+            with server.lock:
+                server.error_count += 1
+            body = json.dumps({'error': {'message': 'Injected error', 'type': 'server_error'}}).encode('utf-8')
+            self.send_response(server.error_status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            if server.error_status == 429:
+                self.send_header('Retry-After', '0')
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        if payload.get('stream'):
+            self.send_stream(request_id, payload)
+            return
+
+        body = json.dumps({
+            'id': request_id,
+            'object': 'chat.completion',
+            'model': payload.get('model', 'mock'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': server.completion},
+                'finish_reason': 'stop'
+            }],
+            'usage': self.usage(payload)
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def usage(self, payload: dict) -> dict:
+        prompt = ''.join(m.get('content', '') for m in payload.get('messages', []))
+        prompt_tokens = len(prompt) // 4
+        completion_tokens = len(self.server.completion) // 4
+        return {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+            'prompt_tokens_details': {'cached_tokens': self.server.cached_prefix_tokens(prompt)}
+        }
+
+    def send_stream(self, request_id: str, payload: dict):
+        server = self.server
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        completion = server.completion
+        for start in range(0, len(completion), server.chunk_size):
+            self.send_event({
+                'id': request_id,
+                'object': 'chat.completion.chunk',
+                'model': payload.get('model', 'mock'),
+                'choices': [{'index': 0, 'delta': {'content': completion[start:start + server.chunk_size]},
+                             'finish_reason': None}]
+            })
+            if server.chunk_delay > 0:
+                time.sleep(server.chunk_delay)
+        self.send_event({
+            'id': request_id,
+            'object': 'chat.completion.chunk',
+            'model': payload.get('model', 'mock'),
+            'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]
+        })
+        if (payload.get('stream_options') or {}).get('include_usage'):
+            self.send_event({
+                'id': request_id,
+                'object': 'chat.completion.chunk',
+                'model': payload.get('model', 'mock'),
+                'choices': [],
+                'usage': self.usage(payload)
+            })
+        self.send_chunk(b'data: [DONE]\n\n')
+        self.send_chunk(b'')
+
+    def send_event(self, event: dict):
+        self.send_chunk(f"data: {json.dumps(event)}\n\n".encode('utf-8'))
+
+    def send_chunk(self, data: bytes):
+        """Write one piece of a chunked transfer-encoded body; empty data ends the body."""
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+
+class MockCompletionsServer(ThreadingHTTPServer):
+    """Local stand-in for the OpenAI chat completions endpoint."""
+
+    daemon_threads = True
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0,
+                 completion: Optional[str] = None, chunk_size: int = 16, chunk_delay: float = 0.0,
+                 jitter: float = 0.0, error_rate: float = 0.0, error_status: int = 503, seed: Optional[int] = None,
+                 model_latency: Optional[Dict[str, float]] = None, slow_rate: float = 0.0, slow_latency: float = 0.0,
+                 latency_per_1k_tokens: float = 0.0):
+        super().__init__((host, port), MockCompletionsHandler)
+        self.latency = latency
+        self.model_latency = dict(model_latency or {})
+        self.latency_per_1k_tokens = latency_per_1k_tokens
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.slow_count = 0
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.error_count = 0
+        self.completion = completion or DEFAULT_COMPLETION
+        self.chunk_size = max(1, chunk_size)
+        self.chunk_delay = chunk_delay
+        self.request_count = 0
+        self.prompt_prefixes = set()
+        self.lock = threading.Lock()
+
+    def cached_prefix_tokens(self, prompt: str) -> int:
+        """Tokens a provider-side prompt cache would serve for this prompt.
+
+        Like the OpenAI API: the longest prefix seen in an earlier prompt, in
+        blocks of 128 tokens, once it is at least 1024 tokens long.
+        """
+        block = 128 * 4
+        digest = hashlib.sha256()
+        prefixes = []
+        for start in range(0, len(prompt) - block + 1, block):
+            digest.update(prompt[start:start + block].encode('utf-8'))
+            prefixes.append(digest.hexdigest())
+        with self.lock:
+            cached = 0
+            for blocks, prefix in enumerate(prefixes, 1):
+                if prefix not in self.prompt_prefixes:
+                    break
+                cached = blocks * 128
+            self.prompt_prefixes.update(prefixes)
+        return cached if cached >= 1024 else 0
+
+    @property
+    def api_base(self) -> str:
+        """Base URL to use as OPENAI_API_BASE."""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> threading.Thread:
+        """Serve requests on a background thread."""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a mock OpenAI chat completions server.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds to wait before each response")
+    parser.add_argument('--chunk-size', type=int, default=16, help="Characters per streamed event")
+    parser.add_argument('--chunk-delay', type=float, default=0.0, help="Seconds between streamed events")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Random +/- seconds added to the latency")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of requests answered with an error")
+    parser.add_argument('--error-status', type=int, default=503, help="HTTP status of injected errors")
+    parser.add_argument('--model-latency', action='append', default=[], metavar='MODEL=SECONDS',
+                        help="Latency for one model instead of --latency; may be repeated")
+    parser.add_argument('--latency-per-1k-tokens', type=float, default=0.0,
+                        help="Extra seconds of latency per 1000 prompt tokens")
+    parser.add_argument('--slow-rate', type=float, default=0.0, help="Share of requests answered after --slow-latency")
+    parser.add_argument('--slow-latency', type=float, default=30.0, help="Seconds to wait before slow responses")
+    args = parser.parse_args()
+
+    model_latency = {}
+    for entry in args.model_latency:
+        model, _, seconds = entry.rpartition('=')
+        model_latency[model] = float(seconds)
+    server = MockCompletionsServer(args.host, args.port, latency=args.latency,
+                                   chunk_size=args.chunk_size, chunk_delay=args.chunk_delay, jitter=args.jitter,
+                                   error_rate=args.error_rate, error_status=args.error_status,
+                                   model_latency=model_latency, slow_rate=args.slow_rate,
+                                   slow_latency=args.slow_latency, latency_per_1k_tokens=args.latency_per_1k_tokens)
+    logging.info(f"Mock completions server listening, set OPENAI_API_BASE={server.api_base}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
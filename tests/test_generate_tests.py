@@ -0,0 +1,177 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import argparse
+import ast
+
+import pytest
+
+import generate_tests
+from generate_tests import StreamNormalizer, merge_test_modules, parse_shard, partition_by_cost
+
+
+def normalize(text):
+    # normalize_completion does not use the generator's state
+    return generate_tests.TestGenerator.normalize_completion(None, text)
+
+
+def stream(chunks):
+    normalizer = StreamNormalizer()
+    return ''.join(normalizer.feed(chunk) for chunk in chunks) + normalizer.finish()
+
+
+EXISTING = '''"""Tests for mod."""
+import pytest
+from mod import f, g
+
+
+class TestFoo:
+    """Tests for Foo."""
+
+    def test_a(self):
+        assert f(1) == 2
+
+    def test_b(self):
+        assert g(1) == 2
+
+
+def test_top():
+    assert True
+'''
+
+
+def test_merge_replaces_method_inside_class():
+    new = '''import pytest
+from mod import g
+
+
+class TestFoo:
+    """Only the changed method."""
+
+    def test_b(self):
+        assert g(2) == 4
+
+    def test_c(self):
+        assert g(0) == 0
+'''
+    merged = merge_test_modules(EXISTING, new)
+    ast.parse(merged)
+    assert 'def test_a(self):\n        assert f(1) == 2' in merged
+    assert 'assert g(2) == 4' in merged
+    assert 'assert g(1) == 2' not in merged
+    assert merged.index('def test_c') < merged.index('def test_top')
+    assert merged.count('class TestFoo') == 1
+    assert '"""Tests for Foo."""' in merged and 'Only the changed method' not in merged
+
+
+def test_merge_reindents_methods_to_existing_class():
+    existing = "class TestT:\n  def test_a(self):\n    assert 1\n"
+    new = "class TestT:\n    def test_b(self):\n        assert 2\n"
+    merged = merge_test_modules(existing, new)
+    ast.parse(merged)
+    assert "\n  def test_b(self):\n" in merged
+
+
+def test_merge_inserts_new_import_after_existing_header():
+    new = '''import json
+import pytest
+from mod import f
+
+
+def test_json():
+    assert json.loads("1") == 1
+'''
+    merged = merge_test_modules(EXISTING, new)
+    ast.parse(merged)
+    lines = merged.splitlines()
+    assert lines.index('import json') == lines.index('from mod import f, g') + 1
+    assert merged.count('import pytest') == 1
+    assert merged.index('import json') < merged.index('class TestFoo')
+    assert merged.rstrip().endswith('assert json.loads("1") == 1')
+
+
+def test_merge_keeps_last_of_duplicate_names_in_new_module():
+    new = '''def test_top():
+    assert 1
+
+
+def test_top():
+    assert 2
+
+
+def test_new():
+    assert 3
+
+
+def test_new():
+    assert 4
+'''
+    merged = merge_test_modules(EXISTING, new)
+    tree = ast.parse(merged)
+    names = [node.name for node in tree.body if isinstance(node, ast.FunctionDef)]
+    assert names == ['test_top', 'test_new']
+    assert 'assert 2' in merged and 'assert 4' in merged
+    assert 'assert 1\n' not in merged and 'assert 3' not in merged
+
+
+def test_merge_skips_statements_already_present():
+    new = 'import pytest\n\nMARKER = 1\n'
+    merged = merge_test_modules(merge_test_modules(EXISTING, new), new)
+    assert merged.count('MARKER = 1') == 1
+
+
+def test_merge_rejects_invalid_modules():
+    with pytest.raises(SyntaxError):
+        merge_test_modules(EXISTING, 'def broken(:\n')
+
+
+COMPLETIONS = [
+    '```python\nimport pytest\n\n\ndef test_quote():\n    assert “a” == ‘a’\n```\n',
+    '```\ndef test_x():\n    assert "```" != "`"\n```',
+    '```python\ndef test_y():\n    pass\n``',
+    '  def test_plain():\n    assert True\n\n',
+    '```python',
+    '``',
+    '',
+]
+
+
+@pytest.mark.parametrize('completion', COMPLETIONS)
+def test_stream_normalizer_matches_normalize_at_every_split(completion):
+    expected = normalize(completion)
+    for split in range(len(completion) + 1):
+        assert stream([completion[:split], completion[split:]]) == expected, split
+    for first in range(len(completion) + 1):
+        for second in range(first, len(completion) + 1):
+            chunks = [completion[:first], completion[first:second], completion[second:]]
+            assert stream(chunks) == expected, (first, second)
+
+
+@pytest.mark.parametrize('completion', COMPLETIONS)
+def test_stream_normalizer_one_character_at_a_time(completion):
+    assert stream(list(completion)) == normalize(completion)
+
+
+def test_partition_by_cost_longest_first():
+    assert partition_by_cost([5, 4, 3, 3, 3], 2) == [0, 1, 1, 0, 1]
+
+
+def test_partition_by_cost_breaks_ties_by_position():
+    assert partition_by_cost([1, 1, 1, 1], 2) == [0, 1, 0, 1]
+    assert partition_by_cost([2.0, 1.0], 4) == [0, 1]
+
+
+def test_partition_by_cost_balances_loads():
+    costs = [float(c) for c in (13, 7, 7, 5, 5, 4, 3, 3, 2, 2, 1, 1)]
+    assignment = partition_by_cost(costs, 3)
+    loads = [sum(c for c, shard in zip(costs, assignment) if shard == s) for s in range(3)]
+    assert set(assignment) == {0, 1, 2}
+    assert max(loads) - min(loads) <= max(costs) / 2
+
+
+def test_parse_shard():
+    assert parse_shard('2/4') == (2, 4)
+    for spec in ('0/4', '5/4', 'x', '1-4'):
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_shard(spec)